@@ -0,0 +1,62 @@
+from collections import OrderedDict
+
+from django.conf import settings
+
+from apps.cart.store import get_cart_store
+from apps.goods.models import GoodsSKU
+
+# 未登录用户的购物车保存在签名的cookie中，不占用服务器存储，登录后一次合并到redis购物车
+# 格式: 商品id_数量.商品id_数量 ... 例如 5_2.12_1
+CART_COOKIE = 'cart'
+CART_COOKIE_SALT = 'dailyfresh.cart'
+
+
+def load_anonymous_cart(request):
+    '''从cookie中读取未登录用户的购物车 {商品id: 数量}，cookie不存在或签名不正确时返回空购物车'''
+    cart = OrderedDict()
+    value = request.get_signed_cookie(CART_COOKIE, default='', salt=CART_COOKIE_SALT,
+                                      max_age=settings.ANONYMOUS_CART_COOKIE_AGE)
+    for item in value.split('.') if value else []:
+        sku_id, _, count = item.partition('_')
+        if sku_id.isdigit() and count.isdigit():
+            cart[int(sku_id)] = int(count)
+    return cart
+
+
+def save_anonymous_cart(response, cart):
+    '''把未登录用户的购物车写入cookie'''
+    if not cart:
+        clear_anonymous_cart(response)
+        return
+    value = '.'.join('%d_%d' % (sku_id, count) for sku_id, count in cart.items())
+    response.set_signed_cookie(CART_COOKIE, value, salt=CART_COOKIE_SALT,
+                               max_age=settings.ANONYMOUS_CART_COOKIE_AGE, httponly=True)
+
+
+def clear_anonymous_cart(response):
+    response.delete_cookie(CART_COOKIE)
+
+
+def has_anonymous_cart(request):
+    '''请求中是否带有未登录用户的购物车(不校验签名)'''
+    return CART_COOKIE in request.COOKIES
+
+
+def merge_anonymous_cart(request, response, user_id):
+    '''登录成功后把cookie中的购物车合并到用户的购物车，合并后的数量不超过库存
+
+    一次mysql查询获取库存，一次redis请求原子地完成合并，返回合并后购物车的条目数
+    '''
+    if not has_anonymous_cart(request):
+        return None
+    cart = load_anonymous_cart(request)
+    clear_anonymous_cart(response)
+    if not cart:
+        return None
+
+    stocks = dict(GoodsSKU.objects.filter(id__in=list(cart)).values_list('id', 'stock'))
+    # 已经删除的商品不合并
+    items = OrderedDict((sku_id, count) for sku_id, count in cart.items() if sku_id in stocks)
+    if not items:
+        return None
+    return get_cart_store().merge(user_id, items, stocks)
@@ -0,0 +1,44 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+from apps.cart.store import CART_KEY, RedisCartStore
+
+
+class Command(BaseCommand):
+    help = '抽样统计redis中每个购物车占用的内存和编码方式'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sample', type=int, default=1000, help='抽样的购物车数')
+
+    def handle(self, *args, **options):
+        conn = get_redis_connection('default')
+        cart_store = RedisCartStore(conn)
+
+        user_ids = []
+        for user_id in cart_store.user_ids():
+            user_ids.append(user_id)
+            if len(user_ids) >= options['sample']:
+                break
+        if not user_ids:
+            self.stdout.write('没有购物车')
+            return
+
+        # 一次请求获取所有抽样购物车的内存占用、编码方式和条目数
+        pipe = conn.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.execute_command('MEMORY', 'USAGE', CART_KEY % user_id)
+            pipe.object('encoding', CART_KEY % user_id)
+            pipe.hlen(CART_KEY % user_id)
+        results = pipe.execute()
+
+        usages = [usage or 0 for usage in results[0::3]]
+        encodings = Counter(encoding.decode() if encoding else 'none' for encoding in results[1::3])
+        lengths = results[2::3]
+
+        self.stdout.write('carts sampled: %d' % len(user_ids))
+        self.stdout.write('bytes per cart: avg %.1f  max %d' % (sum(usages) / len(usages), max(usages)))
+        self.stdout.write('fields per cart: avg %.1f  max %d' % (sum(lengths) / len(lengths), max(lengths)))
+        for encoding, count in encodings.most_common():
+            self.stdout.write('encoding %-10s %d' % (encoding, count))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from apps.cart.store import get_cart_store
+
+
+class Command(BaseCommand):
+    help = '根据购物车重新计算所有用户的购物车总件数，修复计数偏差'
+
+    def handle(self, *args, **options):
+        cart_store = get_cart_store()
+        checked = repaired = 0
+        for user_id in cart_store.user_ids():
+            old, total = cart_store.repair(user_id)
+            checked += 1
+            if old != total:
+                repaired += 1
+                self.stdout.write('user %d: %s -> %d' % (user_id, old, total))
+        self.stdout.write('checked %d carts, repaired %d' % (checked, repaired))
@@ -0,0 +1,389 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from apps.users.history import queue_history
+
+# 用户的购物车 {商品id: 数量}
+CART_KEY = 'cart_%d'
+# 购物车中商品的总件数保存在同一个hash的0字段中(商品id从1开始)，和商品数量在同一个脚本中修改，
+# 读取时不需要遍历购物车，每个购物车只占一个key
+TOTAL_FIELD = 0
+
+# 字段和值都写成不带前导0的整数，小购物车在redis中使用ziplist/listpack编码，整数按整数紧凑存储，
+# 条目数超过hash-max-ziplist-entries(hash-max-listpack-entries)后才转为hashtable
+
+# 所有脚本的KEYS: 购物车
+
+# 重新计算总件数
+REBUILD_TOTAL = '''
+local total = 0
+local data = redis.call('HGETALL', KEYS[1])
+for i = 1, #data, 2 do
+    if data[i] ~= '0' then
+        total = total + tonumber(data[i + 1])
+    end
+end
+redis.call('HSET', KEYS[1], '0', total)
+'''
+
+# 总件数不存在时(例如之前创建的购物车)先计算一次
+ENSURE_TOTAL = '''
+if redis.call('EXISTS', KEYS[1]) == 1 and redis.call('HEXISTS', KEYS[1], '0') == 0 then
+''' + REBUILD_TOTAL + '''
+end
+'''
+
+# 获取总件数
+TOTAL_SCRIPT = ENSURE_TOTAL + '''
+return tonumber(redis.call('HGET', KEYS[1], '0') or 0)
+'''
+
+# 获取购物车条目数
+COUNT_SCRIPT = '''
+return redis.call('HLEN', KEYS[1]) - redis.call('HEXISTS', KEYS[1], '0')
+'''
+
+# 重新计算总件数，返回 {修复前的总件数, 修复后的总件数}，修复前不存在时为-1
+REPAIR_SCRIPT = '''
+local old = tonumber(redis.call('HGET', KEYS[1], '0') or -1)
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {old, 0}
+end
+''' + REBUILD_TOTAL + '''
+if redis.call('HLEN', KEYS[1]) == 1 then
+    redis.call('DEL', KEYS[1])
+    return {old, 0}
+end
+return {old, tonumber(redis.call('HGET', KEYS[1], '0'))}
+'''
+
+# 添加商品，累加后的数量超过库存时不修改
+# ARGV: 商品id, 添加的数量, 商品库存
+# 返回 {累加后的数量, 购物车条目数}，库存不足时返回 {-1, 购物车条目数}
+ADD_SCRIPT = ENSURE_TOTAL + '''
+local count = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or 0) + tonumber(ARGV[2])
+if count <= tonumber(ARGV[3]) then
+    redis.call('HSET', KEYS[1], ARGV[1], count)
+    redis.call('HINCRBY', KEYS[1], '0', ARGV[2])
+else
+    count = -1
+end
+return {count, redis.call('HLEN', KEYS[1]) - redis.call('HEXISTS', KEYS[1], '0')}
+'''
+
+# 设置商品的数量，返回购物车中商品的总件数
+# ARGV: 商品id, 数量
+SET_SCRIPT = ENSURE_TOTAL + '''
+local old = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or 0)
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return redis.call('HINCRBY', KEYS[1], '0', tonumber(ARGV[2]) - old)
+'''
+
+# 删除商品，返回购物车中商品的总件数，购物车中没有商品时删除整个购物车
+# ARGV: 商品id1, 商品id2 ...
+REMOVE_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+''' + ENSURE_TOTAL + '''
+local removed = 0
+for i = 1, #ARGV do
+    local old = redis.call('HGET', KEYS[1], ARGV[i])
+    if old then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+        removed = removed + tonumber(old)
+    end
+end
+if redis.call('HLEN', KEYS[1]) == 1 then
+    redis.call('DEL', KEYS[1])
+    return 0
+end
+return redis.call('HINCRBY', KEYS[1], '0', -removed)
+'''
+
+# 合并未登录时的购物车，合并后的数量不超过库存，返回合并后购物车的条目数
+# ARGV: 商品id1, 数量1, 库存1, 商品id2, 数量2, 库存2 ...
+MERGE_SCRIPT = ENSURE_TOTAL + '''
+local added = 0
+for i = 1, #ARGV, 3 do
+    local old = tonumber(redis.call('HGET', KEYS[1], ARGV[i]) or 0)
+    local count = math.min(old + tonumber(ARGV[i + 1]), tonumber(ARGV[i + 2]))
+    if count > old then
+        redis.call('HSET', KEYS[1], ARGV[i], count)
+        added = added + count - old
+    end
+end
+if added > 0 then
+    redis.call('HINCRBY', KEYS[1], '0', added)
+end
+return redis.call('HLEN', KEYS[1]) - redis.call('HEXISTS', KEYS[1], '0')
+'''
+
+# 批量修改商品的数量，数量为0时删除商品，按顺序执行，返回购物车中商品的总件数
+# ARGV: 商品id1, 数量1, 商品id2, 数量2 ...
+UPDATE_MANY_SCRIPT = ENSURE_TOTAL + '''
+local delta = 0
+for i = 1, #ARGV, 2 do
+    local old = tonumber(redis.call('HGET', KEYS[1], ARGV[i]) or 0)
+    local count = tonumber(ARGV[i + 1])
+    if count > 0 then
+        redis.call('HSET', KEYS[1], ARGV[i], count)
+    else
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+    delta = delta + count - old
+end
+if redis.call('HLEN', KEYS[1]) - redis.call('HEXISTS', KEYS[1], '0') == 0 then
+    redis.call('DEL', KEYS[1])
+    return 0
+end
+return redis.call('HINCRBY', KEYS[1], '0', delta)
+'''
+
+
+def _pack(sku_id):
+    # 商品id统一写成整数，'05'和'5'是同一个商品，并且可以按整数编码
+    return int(sku_id)
+
+
+class CartStore(object):
+    '''购物车存储接口，每个操作都是原子的，商品id和数量都是int'''
+    def add(self, user_id, sku_id, count, stock):
+        '''添加商品，返回(累加后的数量, 购物车条目数)，累加后超过库存时不修改，数量为None'''
+        raise NotImplementedError
+
+    def set(self, user_id, sku_id, count):
+        '''设置商品的数量，返回购物车中商品的总件数'''
+        raise NotImplementedError
+
+    def remove(self, user_id, sku_id):
+        '''删除商品，返回购物车中商品的总件数'''
+        return self.clear_many(user_id, [sku_id])
+
+    def clear_many(self, user_id, sku_ids):
+        '''一次删除多个商品，返回购物车中商品的总件数'''
+        raise NotImplementedError
+
+    def update_many(self, user_id, changes):
+        '''按顺序批量修改商品的数量，changes: [(商品id, 数量), ...]，数量为0时删除商品，返回购物车中商品的总件数'''
+        raise NotImplementedError
+
+    def merge(self, user_id, items, stocks):
+        '''把items {商品id: 数量} 累加到购物车中，累加后的数量不超过stocks {商品id: 库存}，返回购物车条目数'''
+        raise NotImplementedError
+
+    def items(self, user_id, sku_ids=None):
+        '''获取购物车中的商品 {商品id: 数量}，传入sku_ids时只获取这些商品，不在购物车中的商品不在结果中'''
+        raise NotImplementedError
+
+    def count(self, user_id, client=None):
+        '''购物车条目数，client: redis的pipeline，在pipeline中执行时结果从pipeline的execute()中获取'''
+        raise NotImplementedError
+
+    def total(self, user_id):
+        '''购物车中商品的总件数'''
+        raise NotImplementedError
+
+    def repair(self, user_id):
+        '''重新计算总件数，返回(修复前的总件数, 修复后的总件数)，修复前不存在时为None'''
+        raise NotImplementedError
+
+    def user_ids(self):
+        '''遍历所有有购物车的用户id'''
+        raise NotImplementedError
+
+    def count_and_add_history(self, user_id, sku_id):
+        '''详情页：获取购物车条目数，同时添加浏览记录'''
+        raise NotImplementedError
+
+
+class RedisCartStore(CartStore):
+    '''购物车保存在redis的hash中，每个操作一次redis请求'''
+    def __init__(self, conn):
+        self.conn = conn
+        self.add_script = conn.register_script(ADD_SCRIPT)
+        self.set_script = conn.register_script(SET_SCRIPT)
+        self.remove_script = conn.register_script(REMOVE_SCRIPT)
+        self.total_script = conn.register_script(TOTAL_SCRIPT)
+        self.count_script = conn.register_script(COUNT_SCRIPT)
+        self.repair_script = conn.register_script(REPAIR_SCRIPT)
+        self.merge_script = conn.register_script(MERGE_SCRIPT)
+        self.update_many_script = conn.register_script(UPDATE_MANY_SCRIPT)
+
+    def add(self, user_id, sku_id, count, stock):
+        count, cart_len = self.add_script(keys=[CART_KEY % user_id], args=[_pack(sku_id), count, stock])
+        if count < 0:
+            return None, cart_len
+        return count, cart_len
+
+    def set(self, user_id, sku_id, count):
+        return self.set_script(keys=[CART_KEY % user_id], args=[_pack(sku_id), count])
+
+    def clear_many(self, user_id, sku_ids):
+        return self.remove_script(keys=[CART_KEY % user_id], args=[_pack(sku_id) for sku_id in sku_ids])
+
+    def update_many(self, user_id, changes):
+        args = []
+        for sku_id, count in changes:
+            args.extend([_pack(sku_id), count])
+        return self.update_many_script(keys=[CART_KEY % user_id], args=args)
+
+    def merge(self, user_id, items, stocks):
+        args = []
+        for sku_id, count in items.items():
+            args.extend([_pack(sku_id), count, stocks[sku_id]])
+        return self.merge_script(keys=[CART_KEY % user_id], args=args)
+
+    def items(self, user_id, sku_ids=None):
+        cart_key = CART_KEY % user_id
+        if sku_ids is None:
+            data = self.conn.hgetall(cart_key).items()
+        else:
+            ids = [_pack(sku_id) for sku_id in sku_ids]
+            data = zip(ids, self.conn.hmget(cart_key, ids)) if ids else []
+
+        items = OrderedDict()
+        for sku_id, count in data:
+            if count is None:
+                # 商品不在购物车中
+                continue
+            sku_id = int(sku_id)
+            if sku_id != TOTAL_FIELD:
+                items[sku_id] = int(count)
+        return items
+
+    def count(self, user_id, client=None):
+        return self.count_script(keys=[CART_KEY % user_id], client=client)
+
+    def total(self, user_id):
+        return self.total_script(keys=[CART_KEY % user_id])
+
+    def repair(self, user_id):
+        old, total = self.repair_script(keys=[CART_KEY % user_id])
+        return (None if old < 0 else old), total
+
+    def user_ids(self):
+        for key in self.conn.scan_iter(match=CART_KEY.replace('%d', '*'), count=1000):
+            user_id = key.decode().partition('_')[2]
+            if user_id.isdigit():
+                yield int(user_id)
+
+    def count_and_add_history(self, user_id, sku_id):
+        # 条目数和浏览记录的命令放在一个pipeline中，一次redis请求
+        # pipeline中有脚本时execute()会先发送SCRIPT EXISTS，所以不使用条目数脚本
+        key = CART_KEY % user_id
+        pipe = self.conn.pipeline()
+        pipe.hlen(key)
+        pipe.hexists(key, TOTAL_FIELD)
+        queue_history(pipe, user_id, sku_id)
+        length, has_total = pipe.execute()[:2]
+        return length - int(has_total)
+
+
+class MemoryCartStore(CartStore):
+    '''购物车保存在进程内存中，用于测试和性能测试，行为和RedisCartStore一致(不记录浏览记录)'''
+    def __init__(self):
+        self.carts = {}
+        self.lock = threading.Lock()
+
+    def add(self, user_id, sku_id, count, stock):
+        with self.lock:
+            cart = self.carts.setdefault(user_id, OrderedDict())
+            sku_id = _pack(sku_id)
+            count += cart.get(sku_id, 0)
+            if count > stock:
+                if not cart:
+                    del self.carts[user_id]
+                return None, len(cart)
+            cart[sku_id] = count
+            return count, len(cart)
+
+    def set(self, user_id, sku_id, count):
+        with self.lock:
+            cart = self.carts.setdefault(user_id, OrderedDict())
+            cart[_pack(sku_id)] = int(count)
+            return sum(cart.values())
+
+    def clear_many(self, user_id, sku_ids):
+        with self.lock:
+            cart = self.carts.get(user_id)
+            if cart is None:
+                return 0
+            for sku_id in sku_ids:
+                cart.pop(_pack(sku_id), None)
+            if not cart:
+                del self.carts[user_id]
+                return 0
+            return sum(cart.values())
+
+    def update_many(self, user_id, changes):
+        with self.lock:
+            cart = self.carts.setdefault(user_id, OrderedDict())
+            for sku_id, count in changes:
+                if count > 0:
+                    cart[_pack(sku_id)] = count
+                else:
+                    cart.pop(_pack(sku_id), None)
+            if not cart:
+                del self.carts[user_id]
+                return 0
+            return sum(cart.values())
+
+    def merge(self, user_id, items, stocks):
+        with self.lock:
+            cart = self.carts.setdefault(user_id, OrderedDict())
+            for sku_id, count in items.items():
+                old = cart.get(_pack(sku_id), 0)
+                count = min(old + count, stocks[sku_id])
+                if count > old:
+                    cart[_pack(sku_id)] = count
+            if not cart:
+                del self.carts[user_id]
+            return len(cart)
+
+    def items(self, user_id, sku_ids=None):
+        with self.lock:
+            cart = self.carts.get(user_id, {})
+            if sku_ids is None:
+                return OrderedDict(cart)
+            ids = [_pack(sku_id) for sku_id in sku_ids]
+            return OrderedDict((sku_id, cart[sku_id]) for sku_id in ids if sku_id in cart)
+
+    def count(self, user_id, client=None):
+        with self.lock:
+            return len(self.carts.get(user_id, {}))
+
+    def total(self, user_id):
+        with self.lock:
+            return sum(self.carts.get(user_id, {}).values())
+
+    def repair(self, user_id):
+        # 总件数每次计算，不会出现偏差
+        total = self.total(user_id)
+        return total, total
+
+    def user_ids(self):
+        with self.lock:
+            return iter(list(self.carts))
+
+    def count_and_add_history(self, user_id, sku_id):
+        return self.count(user_id)
+
+
+_memory_store = None
+_memory_store_lock = threading.Lock()
+
+
+def get_cart_store():
+    '''根据CART_STORE_BACKEND获取购物车存储：redis 或 memory(进程内共享一个)'''
+    global _memory_store
+    if settings.CART_STORE_BACKEND == 'memory':
+        if _memory_store is None:
+            with _memory_store_lock:
+                if _memory_store is None:
+                    _memory_store = MemoryCartStore()
+        return _memory_store
+    return RedisCartStore(get_redis_connection('default'))
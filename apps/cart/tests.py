@@ -1,3 +1,230 @@
-from django.test import TestCase
+import json
+import os
+import unittest
+from collections import OrderedDict
+from unittest import mock
 
-# Create your tests here.
+import redis
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from apps.cart.anonymous import CART_COOKIE, load_anonymous_cart, save_anonymous_cart
+from apps.cart.store import CART_KEY, TOTAL_FIELD, MemoryCartStore, RedisCartStore
+from apps.goods.models import Goods, GoodsSKU, GoodsType
+from apps.goods.sku_cache import invalidate_sku
+from apps.users.models import User
+
+# redis购物车测试使用单独的redis库，每个测试前清空: TEST_REDIS_URL=redis://127.0.0.1:6379/15
+test_redis = redis.StrictRedis.from_url(os.environ.get('TEST_REDIS_URL', 'redis://127.0.0.1:6379/15'))
+
+
+def redis_available():
+    try:
+        return test_redis.ping()
+    except redis.ConnectionError:
+        return False
+
+
+class CartStoreTestMixin(object):
+    '''每种购物车存储都要通过的测试，子类在setUp中创建self.store'''
+    def test_add_respects_stock(self):
+        self.assertEqual(self.store.add(1, '5', 2, 3), (2, 1))
+        # 累加后超过库存，不修改
+        self.assertEqual(self.store.add(1, 5, 2, 3), (None, 1))
+        self.assertEqual(self.store.add(1, 6, 1, 3), (1, 2))
+        self.assertEqual(self.store.items(1), {5: 2, 6: 1})
+
+    def test_set_remove_and_total(self):
+        self.store.set(1, 5, 2)
+        self.assertEqual(self.store.set(1, 6, 3), 5)
+        self.assertEqual(self.store.remove(1, 5), 3)
+        self.assertEqual(self.store.count(1), 1)
+        self.assertEqual(self.store.total(1), 3)
+        # 购物车为空时删除整个购物车
+        self.assertEqual(self.store.clear_many(1, ['6', 7]), 0)
+        self.assertEqual(list(self.store.user_ids()), [])
+
+    def test_items_subset(self):
+        self.store.set(1, 5, 2)
+        self.store.set(1, 6, 3)
+        self.assertEqual(self.store.items(1, ['6', '7']), {6: 3})
+        self.assertEqual(self.store.items(2), {})
+
+    def test_merge_respects_stock(self):
+        self.store.set(1, 5, 2)
+        self.assertEqual(self.store.merge(1, {5: 3, 6: 4}, {5: 4, 6: 10}), 2)
+        self.assertEqual(self.store.items(1), {5: 4, 6: 4})
+        self.assertEqual(self.store.total(1), 8)
+
+    def test_update_many_in_order(self):
+        self.store.set(1, 5, 2)
+        self.assertEqual(self.store.update_many(1, [(6, 3), (5, 0), (6, 1)]), 1)
+        self.assertEqual(self.store.items(1), {6: 1})
+        self.assertEqual(self.store.update_many(1, [(6, 0)]), 0)
+        self.assertEqual(self.store.count(1), 0)
+
+
+class MemoryCartStoreTest(CartStoreTestMixin, SimpleTestCase):
+    '''进程内购物车存储测试'''
+    def setUp(self):
+        self.store = MemoryCartStore()
+
+
+@unittest.skipUnless(redis_available(), 'redis购物车测试需要redis: TEST_REDIS_URL')
+class RedisCartStoreTest(CartStoreTestMixin, SimpleTestCase):
+    '''redis购物车存储测试'''
+    def setUp(self):
+        self.conn = test_redis
+        self.conn.flushdb()
+        self.store = RedisCartStore(self.conn)
+        self.key = CART_KEY % 1
+
+    def stored_total(self):
+        return int(self.conn.hget(self.key, TOTAL_FIELD))
+
+    def test_total_field(self):
+        self.store.add(1, 5, 2, 10)
+        self.store.set(1, 6, 3)
+        self.store.merge(1, {5: 1, 7: 4}, {5: 10, 7: 10})
+        self.assertEqual(self.stored_total(), 10)
+        self.store.update_many(1, [(7, 1), (6, 0)])
+        self.assertEqual(self.stored_total(), 4)
+        self.store.remove(1, 7)
+        self.assertEqual(self.stored_total(), 3)
+        # 0字段不是商品
+        self.assertEqual(self.store.items(1), {5: 3})
+        self.assertEqual(self.store.items(1, [TOTAL_FIELD, 5]), {5: 3})
+        self.assertEqual(self.store.count(1), 1)
+
+    def test_legacy_cart(self):
+        # 之前创建的购物车没有0字段，第一次修改时先计算总件数
+        self.conn.hset(self.key, 5, 2)
+        self.conn.hset(self.key, 6, 3)
+        self.assertEqual(self.store.count(1), 2)
+        self.assertEqual(self.store.set(1, 5, 4), 7)
+        self.assertEqual(self.stored_total(), 7)
+
+        self.conn.hdel(self.key, TOTAL_FIELD)
+        self.assertEqual(self.store.total(1), 7)
+        self.conn.hdel(self.key, TOTAL_FIELD)
+        self.assertEqual(self.store.add(1, 6, 1, 10), (4, 2))
+        self.assertEqual(self.stored_total(), 8)
+        self.conn.hdel(self.key, TOTAL_FIELD)
+        self.assertEqual(self.store.remove(1, 5), 4)
+
+    def test_empty_cart_deleted(self):
+        self.store.set(1, 5, 2)
+        self.store.remove(1, 5)
+        self.assertFalse(self.conn.exists(self.key))
+        self.store.set(1, 5, 2)
+        self.store.update_many(1, [(6, 1), (5, 0), (6, 0)])
+        self.assertFalse(self.conn.exists(self.key))
+        # 没有商品时不创建购物车
+        self.assertEqual(self.store.clear_many(1, [5]), 0)
+        self.assertEqual(self.store.total(1), 0)
+        self.assertFalse(self.conn.exists(self.key))
+
+    def test_repair(self):
+        self.store.set(1, 5, 2)
+        self.store.set(1, 6, 3)
+        self.conn.hset(self.key, TOTAL_FIELD, 100)
+        self.assertEqual(self.store.repair(1), (100, 5))
+        self.assertEqual(self.store.total(1), 5)
+        # 没有总件数的购物车
+        self.conn.hdel(self.key, TOTAL_FIELD)
+        self.assertEqual(self.store.repair(1), (None, 5))
+        # 只剩总件数的购物车被删除
+        self.conn.hset(CART_KEY % 2, TOTAL_FIELD, 3)
+        self.assertEqual(self.store.repair(2), (3, 0))
+        self.assertFalse(self.conn.exists(CART_KEY % 2))
+        self.assertEqual(self.store.repair(3), (None, 0))
+
+
+class AnonymousCartTest(SimpleTestCase):
+    '''未登录用户cookie购物车测试'''
+    def test_cookie_round_trip(self):
+        response = HttpResponse()
+        save_anonymous_cart(response, OrderedDict([(5, 2), (12, 1)]))
+        request = RequestFactory().get('/')
+        request.COOKIES[CART_COOKIE] = response.cookies[CART_COOKIE].value
+        self.assertEqual(load_anonymous_cart(request), OrderedDict([(5, 2), (12, 1)]))
+
+    def test_bad_signature(self):
+        request = RequestFactory().get('/')
+        request.COOKIES[CART_COOKIE] = '5_2.12_1:forged'
+        self.assertEqual(load_anonymous_cart(request), {})
+
+
+# 测试使用进程内缓存和进程内购物车，不依赖redis
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   CART_STORE_BACKEND='memory')
+class CartBatchViewTest(TestCase):
+    '''批量修改购物车测试'''
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('buyer', 'buyer@example.com', 'password')
+        goods = Goods.objects.create(name='草莓')
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type/fruit.jpg')
+        cls.skus = [GoodsSKU.objects.create(type=type, goods=goods, name='商品%d' % i, desc='简介', price='10.00',
+                                            stock=5, unite='500g', image='goods/%d.jpg' % i) for i in range(2)]
+
+    def setUp(self):
+        # 每个测试使用新的购物车
+        self.store = MemoryCartStore()
+        patcher = mock.patch('apps.cart.store._memory_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for sku in self.skus:
+            invalidate_sku(sku.id)
+        self.store.update_many(self.user.id, [(self.skus[0].id, 1), (self.skus[1].id, 2)])
+        self.client.force_login(self.user)
+
+    def post(self, body):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        return self.client.post('/cart/batch/', body, content_type='application/json').json()
+
+    def assertCartUnchanged(self):
+        self.assertEqual(self.store.items(self.user.id), {self.skus[0].id: 1, self.skus[1].id: 2})
+
+    def test_mixed_batch(self):
+        sku0, sku1 = self.skus[0].id, self.skus[1].id
+        data = self.post({'ops': [{'op': 'set', 'sku_id': sku0, 'count': 3},
+                                  {'op': 'set', 'sku_id': sku1, 'count': 6},
+                                  {'op': 'set', 'sku_id': 0, 'count': 1},
+                                  {'op': 'set', 'sku_id': sku1, 'count': 'x'},
+                                  {'op': 'clear', 'sku_id': sku1},
+                                  {'op': 'remove', 'sku_id': 999}]})
+        self.assertEqual(data['res'], 5)
+        self.assertEqual([result['res'] for result in data['results']], [5, 4, 3, 2, 1, 5])
+        # 校验失败的记录不修改
+        self.assertEqual(self.store.items(self.user.id), {sku0: 3, sku1: 2})
+        self.assertEqual(data['total_count'], 5)
+
+    def test_remove(self):
+        data = self.post({'ops': [{'op': 'remove', 'sku_id': self.skus[0].id}]})
+        self.assertEqual(data['total_count'], 2)
+        self.assertEqual(self.store.items(self.user.id), {self.skus[1].id: 2})
+
+    def test_all_invalid(self):
+        data = self.post({'ops': [{'op': 'set', 'sku_id': self.skus[0].id, 'count': 0}]})
+        self.assertEqual(data['results'][0]['res'], 2)
+        # 没有修改时返回当前的总件数
+        self.assertEqual(data['total_count'], 3)
+        self.assertCartUnchanged()
+
+    @override_settings(CART_BATCH_MAX_OPS=2)
+    def test_max_ops(self):
+        data = self.post({'ops': [{'op': 'remove', 'sku_id': sku.id} for sku in self.skus] * 2})
+        self.assertEqual(data['res'], 1)
+        self.assertCartUnchanged()
+
+    def test_malformed_json(self):
+        for body in ('{"ops": [', '[]', {}, {'ops': []}, {'ops': 'set'}):
+            self.assertEqual(self.post(body)['res'], 1)
+        self.assertCartUnchanged()
+
+    def test_not_logged_in(self):
+        self.client.logout()
+        self.assertEqual(self.post({'ops': [{'op': 'remove', 'sku_id': self.skus[0].id}]})['res'], 0)
+        self.assertCartUnchanged()
@@ -8,5 +8,6 @@ urlpatterns = [
     path('add/', CartAddView.as_view(), name='add'),  # 购物车记录添加
     path('update/', CartUpdateView.as_view(), name='update'),  # 购物车记录更新
     path('delete/', CartDeleteView.as_view(), name='delete'),  # 删除购物车记录
+    path('batch/', CartBatchView.as_view(), name='batch'),  # 批量修改购物车记录
 
 ]
@@ -1,9 +1,13 @@
+import json
+
+from django.conf import settings
 from django.http import JsonResponse
 from django.shortcuts import render
 from django.views import View
-from django_redis import get_redis_connection
 
-from apps.goods.models import GoodsSKU
+from apps.cart.anonymous import load_anonymous_cart, save_anonymous_cart
+from apps.cart.store import get_cart_store
+from apps.goods.sku_cache import get_many_skus, get_sku
 from utils.mixin import LoginRequiresMixin
 
 # 添加商品到购物车：
@@ -17,9 +21,6 @@ class CartAddView(View):
     '''购物车记录添加'''
     def post(self, request):
         user = request.user
-        if not user.is_authenticated:
-            # 用户未登录
-            return JsonResponse({'res': 0, 'errmsg': '请先登录'})
         # 接收数据
         sku_id = request.POST.get('sku_id')
         count = request.POST.get('count')
@@ -36,33 +37,30 @@ class CartAddView(View):
             return JsonResponse({'res': 2, 'errmsg': '商品数目出错'})
 
         # 校验商品是否存在
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
+        sku = get_sku(sku_id)
+        if sku is None:
             # 商品不存在
             return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
 
+        if not user.is_authenticated:
+            # 用户未登录，购物车保存在cookie中，登录后合并
+            cart = load_anonymous_cart(request)
+            if sku.id not in cart and len(cart) >= settings.ANONYMOUS_CART_MAX_LINES:
+                return JsonResponse({'res': 0, 'errmsg': '请先登录'})
+            count += cart.get(sku.id, 0)
+            if count > sku.stock:
+                return JsonResponse({'res': 4, 'errmsg': '商品库存不足'})
+            cart[sku.id] = count
+            response = JsonResponse({'res': 5, 'total_count': len(cart), 'message': '添加成功'})
+            save_anonymous_cart(response, cart)
+            return response
+
         # 业务处理：添加购物车记录
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-        # 先尝试获取sku_id的值
-        # 如果sku_id在hash中不存在，hget返回none
-        cart_count = conn.hget(cart_key, sku_id)
-        if cart_count:
-            # 累加购物车中商品的数目
-            count += int(cart_count)
-
-        # 校验商品的库存
-        if count > sku.stock:
+        # 累加购物车中商品的数目并校验商品的库存，同时返回购物车商品的条目数
+        count, total_count = get_cart_store().add(user.id, sku.id, count, sku.stock)
+        if count is None:
             return JsonResponse({'res': 4, 'errmsg': '商品库存不足'})
 
-        # 设置hash中sku_id对应的值
-        # hset -> 如果sku_id已经存在，更新数据，如果sku_id不存在，添加数据
-        conn.hset(cart_key, sku_id, count)
-
-        # 计算用户购物车商品的条目数
-        total_count = conn.hlen(cart_key)
-
         # 返回应答
         return JsonResponse({'res': 5, 'total_count': total_count, 'message': '添加成功'})
 
@@ -73,21 +71,28 @@ class CartInfoView(LoginRequiresMixin, View):
         user = request.user
 
         # 获取用户购物车中商品的信息
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
+        cart_store = get_cart_store()
         # 商品id：商品数量
-        cart_dict = conn.hgetall(cart_key)
+        cart_dict = cart_store.items(user.id)
+
+        # 一次获取购物车中所有商品的信息 {id: sku}
+        sku_dict = get_many_skus(cart_dict)
 
         skus = []
+        # 已经不存在的商品
+        invalid_ids = []
         # 保护用户购物车中商品的总数目和总价格
         total_count = 0
         total_price = 0
-        # 遍历获取商品的信息
+        # 按照购物车中的顺序遍历商品的信息
         for sku_id, count in cart_dict.items():
-            # 根据商品id获取商品信息
-            sku = GoodsSKU.objects.get(id=sku_id)
+            sku = sku_dict.get(sku_id)
+            if sku is None:
+                # 商品已被删除，跳过
+                invalid_ids.append(sku_id)
+                continue
             # 计算商品的小计
-            amount = sku.price*int(count)
+            amount = sku.price*count
             # 动态给sku增加一个属性amount，保存商品的小计
             sku.amount = amount
             # 动态给sku增加一个属性count，保存购物车中对应商品的数量
@@ -96,9 +101,13 @@ class CartInfoView(LoginRequiresMixin, View):
             skus.append(sku)
 
             # 累加计算商品的总数目和总价格
-            total_count += int(count)
+            total_count += count
             total_price += amount
 
+        # 从购物车中清除已经不存在的商品
+        if invalid_ids:
+            cart_store.clear_many(user.id, invalid_ids)
+
         # 组织上下文
         context = {'total_count': total_count,
                    'total_price': total_price,
@@ -134,28 +143,18 @@ class CartUpdateView(View):
             return JsonResponse({'res': 2, 'errmsg': '商品数目出错'})
 
         # 校验商品是否存在
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
+        sku = get_sku(sku_id)
+        if sku is None:
             # 商品不存在
             return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
 
         # 业务处理：更新购物车记录
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-
         # 校验商品库存
         if count > sku.stock:
             return JsonResponse({'res': 4, 'errmsg': '商品库存不足'})
 
-        # 更新
-        conn.hset(cart_key, sku_id, count)
-
-        # 计算用户购物车中商品的总件数
-        total_count = 0
-        vals = conn.hvals(cart_key)
-        for val in vals:
-            total_count += int(val)
+        # 更新，同时计算用户购物车中商品的总件数
+        total_count = get_cart_store().set(user.id, sku.id, count)
 
         # 返回应答
         return JsonResponse({'res': 5, 'total_count': total_count, 'message': '更新成功'})
@@ -180,24 +179,95 @@ class CartDeleteView(View):
             return JsonResponse({'res': 1, 'errmsg': '无效的商品'})
 
         # 校验商品是否存在
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
+        sku = get_sku(sku_id)
+        if sku is None:
             # 商品不存在
             return JsonResponse({'res': 2, 'errmsg': '商品不存在'})
 
         # 业务处理：删除购物车记录
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
+        # 删除，同时计算用户购物车中商品的总件数
+        total_count = get_cart_store().remove(user.id, sku.id)
 
-        # 删除
-        conn.hdel(cart_key, sku_id)
+        # 返回应答
+        return JsonResponse({'res': 3, 'total_count': total_count, 'message': '删除成功'})
 
-        # 计算用户购物车中商品的总件数
-        total_count = 0
-        vals = conn.hvals(cart_key)
-        for val in vals:
-            total_count += int(val)
+
+# 批量修改购物车记录
+# 采用ajax  post请求，请求体为json: {"ops": [{"op": "set", "sku_id": 1, "count": 2}, {"op": "remove", "sku_id": 3}, ...]}
+# 一次查询校验所有商品和库存，一次redis请求按顺序完成所有修改，校验失败的记录不修改
+# cart/batch/
+class CartBatchView(View):
+    '''批量修改购物车记录'''
+    def post(self, request):
+        user = request.user
+        if not user.is_authenticated:
+            # 用户未登录
+            return JsonResponse({'res': 0, 'errmsg': '请先登录'})
+
+        # 接收数据
+        try:
+            ops = json.loads(request.body.decode())['ops']
+        except (ValueError, KeyError, TypeError):
+            return JsonResponse({'res': 1, 'errmsg': '数据不完整'})
+
+        # 数据校验
+        if not isinstance(ops, list) or not ops:
+            return JsonResponse({'res': 1, 'errmsg': '数据不完整'})
+        if len(ops) > settings.CART_BATCH_MAX_OPS:
+            return JsonResponse({'res': 1, 'errmsg': '一次最多修改%d条记录' % settings.CART_BATCH_MAX_OPS})
+
+        # 一次获取所有商品的信息 {id: sku}
+        sku_ids = [op.get('sku_id') for op in ops if isinstance(op, dict)]
+        sku_dict = get_many_skus(sku_ids)
+
+        results = []
+        # 校验通过的修改 [(商品id, 数量)]，数量为0表示删除
+        changes = []
+        for op in ops:
+            result = self.check_op(op, sku_dict)
+            results.append(result)
+            if result['res'] == 5:
+                changes.append((result['sku_id'], result.get('count', 0)))
+
+        # 业务处理：一次完成所有修改，同时计算用户购物车中商品的总件数
+        cart_store = get_cart_store()
+        if changes:
+            total_count = cart_store.update_many(user.id, changes)
+        else:
+            total_count = cart_store.total(user.id)
 
         # 返回应答
-        return JsonResponse({'res': 3, 'total_count': total_count, 'message': '删除成功'})
+        return JsonResponse({'res': 5, 'total_count': total_count, 'results': results, 'message': '更新成功'})
+
+    def check_op(self, op, sku_dict):
+        '''校验一条修改，返回这条修改的结果，res为5时校验通过'''
+        if not isinstance(op, dict) or op.get('op') not in ('set', 'remove'):
+            return {'res': 1, 'errmsg': '数据不完整'}
+
+        try:
+            sku_id = int(op.get('sku_id'))
+        except (TypeError, ValueError):
+            return {'res': 3, 'errmsg': '商品不存在'}
+
+        if op['op'] == 'remove':
+            # 已经删除的商品也可以从购物车中删除
+            return {'res': 5, 'op': 'remove', 'sku_id': sku_id}
+
+        # 校验商品数量
+        try:
+            count = int(op.get('count'))
+        except (TypeError, ValueError):
+            return {'res': 2, 'sku_id': sku_id, 'errmsg': '商品数目出错'}
+        if count <= 0:
+            return {'res': 2, 'sku_id': sku_id, 'errmsg': '商品数目出错'}
+
+        # 校验商品是否存在
+        sku = sku_dict.get(sku_id)
+        if sku is None:
+            return {'res': 3, 'sku_id': sku_id, 'errmsg': '商品不存在'}
+
+        # 校验商品库存
+        if count > sku.stock:
+            return {'res': 4, 'sku_id': sku_id, 'errmsg': '商品库存不足'}
+
+        return {'res': 5, 'op': 'set', 'sku_id': sku_id, 'count': count}
@@ -1,5 +1,97 @@
 from django.contrib import admin
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from apps.goods.loaders import bump_index_data_version, clear_type_sku_count
 from apps.goods.models import *
+from apps.orders.reservation import adjust_stock
+from celery_tasks.tasks import schedule_static_index_html
+
+
+class BaseModelAdmin(admin.ModelAdmin):
+    '''首页展示数据的管理类，数据发生变化时更新首页缓存和静态页面'''
+    def index_data_changed(self):
+        # 都在事务提交后进行，否则并发的请求可能把修改前的数据缓存到新的版本号下，
+        # worker也可能读到修改前的数据
+        # 首页数据缓存版本号加1
+        transaction.on_commit(bump_index_data_version)
+        # 发出任务，让celery worker重新生成首页静态页
+        transaction.on_commit(schedule_static_index_html)
+
+    def save_model(self, request, obj, form, change):
+        '''新增或更新表中的数据时调用'''
+        super().save_model(request, obj, form, change)
+        self.index_data_changed()
+
+    def delete_model(self, request, obj):
+        '''删除表中的数据时调用'''
+        super().delete_model(request, obj)
+        self.index_data_changed()
+
+    def delete_queryset(self, request, queryset):
+        '''后台列表页批量删除时调用'''
+        super().delete_queryset(request, queryset)
+        self.index_data_changed()
+
+
+class GoodsTypeAdmin(BaseModelAdmin):
+    pass
+
+
+class IndexGoodsBannerAdmin(BaseModelAdmin):
+    pass
+
+
+class IndexTypeGoodsBannerAdmin(BaseModelAdmin):
+    pass
+
+
+class IndexPromotionBannerAdmin(BaseModelAdmin):
+    pass
+
+
+class GoodsSKUAdmin(admin.ModelAdmin):
+    '''商品管理类，修改库存后调整redis中的库存计数器，种类的商品变化时清除商品数量缓存'''
+    def save_model(self, request, obj, form, change):
+        if change:
+            # 锁定商品到事务结束，期间库存计数器不能从mysql重新加载，写回任务也不能修改库存
+            old_type_id, old_stock = GoodsSKU.objects.select_for_update().values_list('type_id', 'stock').get(id=obj.id)
+        super().save_model(request, obj, form, change)
+        self.index_skus_changed([obj.id])
+        if change and obj.stock != old_stock:
+            # 计数器加上库存的变化量，不删除计数器，进行中的预留不受影响
+            adjust_stock(get_redis_connection('default'), obj.id, obj.stock - old_stock)
+        if not change:
+            clear_type_sku_count(obj.type_id)
+        elif old_type_id != obj.type_id:
+            clear_type_sku_count(old_type_id)
+            clear_type_sku_count(obj.type_id)
+
+    def delete_model(self, request, obj):
+        # 删除前检查，删除商品时首页的展示记录也会被删除
+        self.index_skus_changed([obj.id])
+        super().delete_model(request, obj)
+        clear_type_sku_count(obj.type_id)
+
+    def delete_queryset(self, request, queryset):
+        type_ids = set(queryset.values_list('type_id', flat=True))
+        self.index_skus_changed(queryset.values_list('id', flat=True))
+        super().delete_queryset(request, queryset)
+        for type_id in type_ids:
+            clear_type_sku_count(type_id)
+
+    def index_skus_changed(self, sku_ids):
+        '''首页展示的商品修改或删除后，事务提交后使首页数据缓存失效，重新生成首页静态页'''
+        sku_ids = list(sku_ids)
+        if IndexGoodsBanner.objects.filter(sku_id__in=sku_ids).exists() or \
+                IndexTypeGoodsBanner.objects.filter(sku_id__in=sku_ids).exists():
+            transaction.on_commit(bump_index_data_version)
+            transaction.on_commit(schedule_static_index_html)
 
 
-admin.site.register([GoodsType, GoodsSKU, Goods, GoodsImage, IndexGoodsBanner, IndexTypeGoodsBanner, IndexPromotionBanner])
+admin.site.register([Goods, GoodsImage])
+admin.site.register(GoodsSKU, GoodsSKUAdmin)
+admin.site.register(GoodsType, GoodsTypeAdmin)
+admin.site.register(IndexGoodsBanner, IndexGoodsBannerAdmin)
+admin.site.register(IndexTypeGoodsBanner, IndexTypeGoodsBannerAdmin)
+admin.site.register(IndexPromotionBanner, IndexPromotionBannerAdmin)
@@ -1,5 +1,14 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class GoodsConfig(AppConfig):
     name = 'apps.goods'
+
+    def ready(self):
+        from apps.goods.models import GoodsSKU
+        from apps.goods.sku_cache import sku_changed
+
+        # 商品修改或删除后清除商品缓存
+        post_save.connect(sku_changed, sender=GoodsSKU, dispatch_uid='goods_sku_cache_save')
+        post_delete.connect(sku_changed, sender=GoodsSKU, dispatch_uid='goods_sku_cache_delete')
@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from apps.goods.models import GoodsSKU, GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner
+
+
+def load_index_data():
+    '''获取首页展示的数据(与登录用户无关的部分)，固定4条查询'''
+    # 获取商品种类信息
+    types = list(GoodsType.objects.all())
+
+    # 获取首页轮播商品信息，模板中会访问goods_banner.sku，一并查出
+    goods_banners = list(IndexGoodsBanner.objects.select_related('sku').order_by('index'))
+
+    # 获取首页促销活动信息
+    promotion_banners = list(IndexPromotionBanner.objects.all().order_by('index'))
+
+    # 一次查出所有种类的首页分类商品展示信息，在内存中按种类和展示类型分组
+    # 0 文字展示 1 图片展示
+    type_banners = {}
+    for banner in IndexTypeGoodsBanner.objects.select_related('sku').order_by('index'):
+        type_banners.setdefault((banner.type_id, banner.display_type), []).append(banner)
+
+    for type in types:  # GoodsType
+        # 动态给type增加属性，分别保存首页分类商品的图片展示信息和文字展示信息
+        type.image_banners = type_banners.get((type.id, 1), [])
+        type.title_banners = type_banners.get((type.id, 0), [])
+
+    return {'types': types,
+            'goods_banners': goods_banners,
+            'promotion_banners': promotion_banners}
+
+
+# 首页数据缓存的key和版本号key
+INDEX_DATA_CACHE_KEY = 'index_page_data'
+INDEX_DATA_VERSION_KEY = 'index_page_data_version'
+
+
+def get_index_data():
+    '''获取首页展示的数据，优先读取缓存，缓存不存在或版本过期时查询数据库'''
+    # 数据和版本号一次读出(mget)
+    cached = cache.get_many([INDEX_DATA_CACHE_KEY, INDEX_DATA_VERSION_KEY])
+    version = cached.get(INDEX_DATA_VERSION_KEY, 0)
+    data = cached.get(INDEX_DATA_CACHE_KEY)
+    if data is not None and data['version'] == version:
+        return data['context']
+
+    # 先读版本号再查数据库，查询期间数据有修改时写入的是旧版本号，下次访问会重新查询
+    context = load_index_data()
+    cache.set(INDEX_DATA_CACHE_KEY, {'version': version, 'context': context}, settings.INDEX_DATA_CACHE_TIMEOUT)
+    return context
+
+
+def bump_index_data_version():
+    '''首页数据发生变化时调用，版本号加1使缓存失效'''
+    # 版本号不设置过期时间
+    cache.add(INDEX_DATA_VERSION_KEY, 0, None)
+    cache.incr(INDEX_DATA_VERSION_KEY)
+
+
+# 种类的商品数量
+TYPE_SKU_COUNT_KEY = 'type_sku_count_%d'
+
+
+def get_type_sku_count(type_id):
+    '''获取种类的商品数量，用于计算列表页的总页数'''
+    return cache.get_or_set(TYPE_SKU_COUNT_KEY % type_id,
+                            lambda: GoodsSKU.objects.filter(type_id=type_id).count(),
+                            settings.TYPE_SKU_COUNT_CACHE_TIMEOUT)
+
+
+def clear_type_sku_count(type_id):
+    '''种类的商品增加或删除时调用，事务提交后才清除，避免并发的请求把提交前的数量重新缓存'''
+    transaction.on_commit(lambda: cache.delete(TYPE_SKU_COUNT_KEY % type_id))
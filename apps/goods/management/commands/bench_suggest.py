@@ -0,0 +1,49 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+from haystack import connections
+from whoosh.query import Prefix
+
+from apps.goods.models import GoodsSKU
+from apps.goods.suggest import suggest
+
+
+class Command(BaseCommand):
+    help = '对比redis前缀索引和whoosh前缀查询的搜索联想耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queries', nargs='*', help='测试的关键字，默认使用商品名称的前1-2个字')
+        parser.add_argument('--rounds', type=int, default=1000, help='每个关键字的查询次数')
+
+    def handle(self, *args, **options):
+        queries = options['queries']
+        if not queries:
+            names = GoodsSKU.objects.values_list('name', flat=True)[:20]
+            queries = sorted({name[:length] for name in names for length in (1, 2) if name[:length]})
+        if not queries:
+            self.stdout.write('没有商品')
+            return
+        rounds = options['rounds']
+
+        conn = get_redis_connection('default')
+        backend = connections['default'].get_backend()
+        backend.setup()
+
+        def redis_suggest(query):
+            return suggest(conn, query)
+
+        def whoosh_suggest(query):
+            with backend.index.searcher() as searcher:
+                hits = searcher.search(Prefix('text', query), limit=settings.SUGGEST_LIMIT)
+                return [hit.get('name') for hit in hits]
+
+        for name, func in (('redis', redis_suggest), ('whoosh', whoosh_suggest)):
+            start = time.perf_counter()
+            for i in range(rounds):
+                for query in queries:
+                    func(query)
+            elapsed = time.perf_counter() - start
+            self.stdout.write('%-8s %d queries  avg %.1f us/query' % (
+                name, rounds * len(queries), elapsed / (rounds * len(queries)) * 10**6))
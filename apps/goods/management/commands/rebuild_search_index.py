@@ -0,0 +1,94 @@
+import os
+import shutil
+import time
+
+from django.core.management.base import BaseCommand
+from haystack import connections
+from haystack.exceptions import SkipDocument
+from whoosh import index as whoosh_index
+
+from apps.goods.models import GoodsSKU
+
+
+class Command(BaseCommand):
+    help = '多进程重建商品的搜索索引：按id分批读取商品，多个进程分词(jieba)并各自写入段，最后合并段'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='分词和写入的进程数')
+        parser.add_argument('--batch-size', type=int, default=1000, help='每批读取的商品数')
+        parser.add_argument('--limitmb', type=int, default=128, help='每个进程写入时使用的内存(MB)')
+        parser.add_argument('--no-optimize', action='store_true', help='不合并段')
+
+    def handle(self, *args, **options):
+        backend = connections['default'].get_backend()
+        backend.setup()
+        index = connections['default'].get_unified_index().get_index(GoodsSKU)
+
+        # 在临时目录中建立新索引，完成后替换原来的索引，重建期间搜索不受影响
+        # 重建期间由队列写入旧索引的修改不会进入新索引，应在没有商品修改时运行
+        path = backend.path.rstrip(os.sep)
+        build_path = path + '.rebuild'
+        shutil.rmtree(build_path, ignore_errors=True)
+        os.makedirs(build_path)
+        ix = whoosh_index.create_in(build_path, backend.schema)
+
+        start = time.perf_counter()
+        # 每个进程分词后写入自己的段，multisegment=True时提交时不合并
+        writer = ix.writer(procs=options['workers'], multisegment=options['workers'] > 1,
+                           limitmb=options['limitmb'])
+        count = 0
+        try:
+            for skus in self.iter_batches(index, options['batch_size']):
+                for sku in skus:
+                    doc = self.prepare(backend, index, sku)
+                    if doc is not None:
+                        writer.add_document(**doc)
+                        count += 1
+                self.stdout.write('indexed %d' % count)
+            writer.commit()
+        except BaseException:
+            writer.cancel()
+            raise
+        elapsed = time.perf_counter() - start
+        segments = len(ix._segments())
+
+        optimize_elapsed = 0
+        if not options['no_optimize'] and segments > 1:
+            # 合并所有段，搜索时只需要读取一个段
+            optimize_start = time.perf_counter()
+            ix.optimize()
+            optimize_elapsed = time.perf_counter() - optimize_start
+        ix.close()
+
+        # 替换原来的索引
+        old_path = path + '.old'
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(build_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+        self.stdout.write('indexed %d docs in %.2fs (%.0f docs/sec), %d segments, optimize %.2fs' % (
+            count, elapsed, count / elapsed if elapsed else 0, segments, optimize_elapsed))
+
+    def iter_batches(self, index, batch_size):
+        '''按id顺序分批读取商品，不一次加载整张表'''
+        last_id = 0
+        while True:
+            skus = list(index.index_queryset().filter(id__gt=last_id).select_related('goods')
+                        .order_by('id')[:batch_size])
+            if not skus:
+                return
+            yield skus
+            last_id = skus[-1].id
+
+    def prepare(self, backend, index, sku):
+        '''和haystack的whoosh后端写入的文档相同'''
+        try:
+            doc = index.full_prepare(sku)
+        except SkipDocument:
+            return None
+        for key in doc:
+            doc[key] = backend._from_python(doc[key])
+        doc.pop('boost', None)
+        return doc
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+from apps.goods.suggest import rebuild_suggestions
+
+
+class Command(BaseCommand):
+    help = '重建搜索联想的前缀索引，同时刷新销量权重'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='每批读取的商品数')
+
+    def handle(self, *args, **options):
+        count = rebuild_suggestions(get_redis_connection('default'), options['batch_size'])
+        self.stdout.write('rebuilt %d suggestions' % count)
@@ -0,0 +1,29 @@
+# Generated by Django 2.0.6 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goods', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='goodssku',
+            index=models.Index(fields=['type', 'price', 'id'], name='goods_sku_type_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='goodssku',
+            index=models.Index(fields=['type', 'sales', 'id'], name='goods_sku_type_sales_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='goodssku',
+            index=models.Index(fields=['type', 'create_time'], name='goods_sku_type_ctime_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='indextypegoodsbanner',
+            index=models.Index(fields=['type', 'display_type', 'index'], name='index_type_goods_type_idx'),
+        ),
+    ]
@@ -41,6 +41,12 @@ class GoodsSKU(BaseModel):
 
     class Meta:
         db_table = 'df_goods_sku'
+        # 列表页按种类筛选，按价格、销量、创建时间排序
+        indexes = [
+            models.Index(fields=['type', 'price', 'id'], name='goods_sku_type_price_idx'),
+            models.Index(fields=['type', 'sales', 'id'], name='goods_sku_type_sales_idx'),
+            models.Index(fields=['type', 'create_time'], name='goods_sku_type_ctime_idx'),
+        ]
         verbose_name = '商品'
         verbose_name_plural = verbose_name
 
@@ -105,6 +111,9 @@ class IndexTypeGoodsBanner(BaseModel):
 
     class Meta:
         db_table = 'df_index_type_goods'
+        indexes = [
+            models.Index(fields=['type', 'display_type', 'index'], name='index_type_goods_type_idx'),
+        ]
         verbose_name = "主页分类展示商品"
         verbose_name_plural = verbose_name
 
@@ -0,0 +1,90 @@
+import hashlib
+import json
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from haystack import connections
+from whoosh import sorting
+from whoosh.query import And, NumericRange, Term
+
+from apps.goods.models import GoodsSKU
+
+# 搜索结果的缓存 (关键字, 筛选条件, 页码) -> 这一页的商品、结果总数和各种类的商品数
+SEARCH_CACHE_KEY = 'search_%s'
+
+# 排序方式: (排序字段, 是否倒序)，默认按相关度排序
+SEARCH_ORDERINGS = {
+    'price': ('price', False),
+    'hot': ('sales', True),
+}
+
+
+def _cache_key(query, filters, page):
+    # 关键字可能包含空格等缓存key不支持的字符
+    data = json.dumps([query, sorted(filters.items()), page], default=str)
+    return SEARCH_CACHE_KEY % hashlib.md5(data.encode()).hexdigest()
+
+
+def _filter_query(filters, with_type=True):
+    # 筛选条件在搜索引擎中执行，和关键字搜索一起完成
+    terms = [Term('django_ct', GoodsSKU._meta.label_lower)]
+    if with_type and filters.get('type_id') is not None:
+        terms.append(Term('type_id', filters['type_id']))
+    if filters.get('min_price') is not None or filters.get('max_price') is not None:
+        terms.append(NumericRange('price', filters.get('min_price'), filters.get('max_price')))
+    if filters.get('in_stock'):
+        terms.append(Term('in_stock', True))
+    return And(terms)
+
+
+def _type_counts(results):
+    return {int(type_id): count for type_id, count in results.groups('type_id').items()}
+
+
+def search_skus(query, page, per_page, filters=None):
+    '''搜索商品，返回 {'results': [商品信息], 'count': 结果总数, 'type_counts': {种类id: 商品数}}
+
+    filters: type_id 种类, min_price/max_price 价格区间, in_stock 只看有货, sort 排序方式(price/hot)
+    筛选、排序和种类统计都在whoosh中完成，商品信息直接从索引的存储字段中获取，不查询数据库；
+    结果缓存SEARCH_CACHE_TIMEOUT秒，热门关键字一次缓存读取
+    '''
+    filters = {key: value for key, value in (filters or {}).items() if value is not None}
+    key = _cache_key(query, filters, page)
+    data = cache.get(key)
+    if data is not None:
+        return data
+
+    # haystack的whoosh后端不支持分面统计，直接使用whoosh查询
+    # 种类、价格、销量是可排序的列(apps.goods.whoosh_backend)，排序和统计不需要扫描整个字段
+    backend = connections['default'].get_backend()
+    if not backend.setup_complete:
+        backend.setup()
+    text_query = backend.parser.parse(query)
+
+    sortedby, reverse = SEARCH_ORDERINGS.get(filters.get('sort'), (None, False))
+    type_facet = {'type_id': sorting.FieldFacet('type_id', maptype=sorting.Count)}
+
+    with backend.index.searcher() as searcher:
+        results = searcher.search_page(text_query, page, pagelen=per_page, filter=_filter_query(filters),
+                                       sortedby=sortedby, reverse=reverse, groupedby=type_facet)
+        items = []
+        for hit in results:
+            items.append({'id': int(hit['django_id']),
+                          'name': hit['name'],
+                          'price': Decimal('%.2f' % hit['price']),
+                          'unite': hit['unite'],
+                          'image_url': default_storage.url(hit['image'])})
+        data = {'results': items, 'count': results.total}
+
+        if filters.get('type_id') is None:
+            data['type_counts'] = _type_counts(results.results)
+        else:
+            # 选择了种类时，各种类的商品数不受种类筛选的影响
+            all_types = searcher.search(text_query, limit=1, filter=_filter_query(filters, with_type=False),
+                                        groupedby=type_facet)
+            data['type_counts'] = _type_counts(all_types)
+
+    cache.set(key, data, settings.SEARCH_CACHE_TIMEOUT)
+    return data
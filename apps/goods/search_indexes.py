@@ -10,10 +10,30 @@ class GoodsSKUIndex(indexes.SearchIndex, indexes.Indexable):
     # 索引字段  use_template=True指定根据表中的哪些字段建立索引文件,把说明放在一个文件中
     text = indexes.CharField(document=True, use_template=True)
 
+    # 只存储不检索的字段，搜索结果页直接使用，不需要再从数据库查询商品
+    name = indexes.CharField(model_attr='name', indexed=False)
+    unite = indexes.CharField(model_attr='unite', indexed=False)
+    # 图片在存储中的路径
+    image = indexes.CharField(indexed=False)
+
+    # 数值字段，在搜索引擎中按种类、价格区间、是否有货筛选，按价格、销量排序，统计各种类的商品数
+    # 种类、价格、销量在索引中是可排序的列，见apps.goods.whoosh_backend
+    type_id = indexes.IntegerField(model_attr='type_id')
+    price = indexes.FloatField(model_attr='price')
+    sales = indexes.IntegerField(model_attr='sales')
+    status = indexes.IntegerField(model_attr='status')
+    in_stock = indexes.BooleanField()
+
     def get_model(self):
         # 返回模型类
         return GoodsSKU
 
+    def prepare_image(self, obj):
+        return obj.image.name
+
+    def prepare_in_stock(self, obj):
+        return obj.stock > 0
+
     # 建立索引的数据
     def index_queryset(self, using=None):
         return self.get_model().objects.all()
@@ -0,0 +1,121 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django_redis import get_redis_connection
+from haystack import connections
+from haystack.signals import BaseSignalProcessor
+
+from apps.goods.models import Goods, GoodsSKU
+from apps.goods.suggest import remove_sku_suggestions, update_suggestions
+
+# 搜索索引的更新不在请求中进行：修改的商品id放入redis集合，由celery任务批量更新索引
+# 待更新索引的商品id集合
+SEARCH_INDEX_QUEUE_KEY = 'search_index_queue'
+
+# 不影响搜索索引的字段，只修改这些字段时不更新索引
+# 索引中只有是否有货，库存的修改只在有货和无货之间变化时才更新索引
+NON_INDEXED_FIELDS = ('stock', 'create_time', 'update_time')
+
+INDEXED_FIELDS = [field.attname for field in GoodsSKU._meta.concrete_fields
+                  if field.attname not in NON_INDEXED_FIELDS]
+
+
+def _snapshot(instance):
+    # 延迟加载的字段不在__dict__中，不触发查询
+    stock = instance.__dict__.get('stock')
+    in_stock = None if stock is None else stock > 0
+    return tuple(instance.__dict__.get(attname) for attname in INDEXED_FIELDS) + (in_stock,)
+
+
+def remember_indexed_values(sender, instance, **kwargs):
+    '''GoodsSKU的post_init信号处理函数，记录索引字段的原始值，保存时判断是否需要更新索引'''
+    instance._search_snapshot = _snapshot(instance)
+
+
+def enqueue_skus(sku_ids):
+    '''把需要更新索引的商品放入队列，事务提交后再放入，并调度批量更新任务'''
+    sku_ids = list(sku_ids)
+    if not sku_ids:
+        return
+
+    def enqueue():
+        # celery_tasks.tasks导入了各app的模块，在这里导入避免循环导入
+        from celery_tasks.tasks import schedule_search_index_update
+
+        get_redis_connection('default').sadd(SEARCH_INDEX_QUEUE_KEY, *sku_ids)
+        schedule_search_index_update()
+
+    transaction.on_commit(enqueue)
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    '''商品修改或删除时把商品id放入队列，由celery任务批量更新索引，不在请求中写whoosh索引
+
+    只修改了不影响索引的字段(例如库存在有货时的变化)时不更新索引
+    '''
+    def setup(self):
+        post_init.connect(remember_indexed_values, sender=GoodsSKU, dispatch_uid='goods_sku_search_init')
+        post_save.connect(self.handle_save, sender=GoodsSKU)
+        post_delete.connect(self.handle_delete, sender=GoodsSKU)
+        # 商品SPU的详情也在索引中
+        post_save.connect(self.handle_goods_save, sender=Goods)
+
+    def teardown(self):
+        post_init.disconnect(remember_indexed_values, sender=GoodsSKU, dispatch_uid='goods_sku_search_init')
+        post_save.disconnect(self.handle_save, sender=GoodsSKU)
+        post_delete.disconnect(self.handle_delete, sender=GoodsSKU)
+        post_save.disconnect(self.handle_goods_save, sender=Goods)
+
+    def handle_save(self, sender, instance, created=False, update_fields=None, **kwargs):
+        if update_fields and 'stock' not in update_fields and set(update_fields).issubset(NON_INDEXED_FIELDS):
+            # save(update_fields=...)只修改了不在索引中的字段，不需要比较快照
+            # 库存可能在有货和无货之间变化，由下面的快照比较判断
+            return
+        if not created:
+            snapshot = getattr(instance, '_search_snapshot', None)
+            if snapshot is not None and snapshot == _snapshot(instance):
+                return
+        instance._search_snapshot = _snapshot(instance)
+        enqueue_skus([instance.id])
+
+    def handle_delete(self, sender, instance, **kwargs):
+        # 队列中已经不存在的商品从索引中删除
+        enqueue_skus([instance.id])
+
+    def handle_goods_save(self, sender, instance, created=False, **kwargs):
+        if created:
+            # 新的SPU还没有SKU
+            return
+        enqueue_skus(GoodsSKU.objects.filter(goods_id=instance.id).values_list('id', flat=True))
+
+
+def process_search_index_queue(conn, batch_size=None):
+    '''从队列中批量取出商品更新索引，每批一次mysql查询、一次写入索引，返回更新的商品数'''
+    batch_size = batch_size or settings.SEARCH_INDEX_BATCH_SIZE
+    backend = connections['default'].get_backend()
+    index = connections['default'].get_unified_index().get_index(GoodsSKU)
+
+    updated = 0
+    while True:
+        sku_ids = conn.execute_command('SPOP', SEARCH_INDEX_QUEUE_KEY, batch_size) or []
+        sku_ids = [int(sku_id) for sku_id in sku_ids]
+        if not sku_ids:
+            return updated
+        try:
+            skus = list(index.index_queryset().filter(id__in=sku_ids).select_related('goods'))
+            if skus:
+                backend.update(index, skus)
+                # 同时更新搜索联想
+                update_suggestions(conn, skus)
+            # 已经删除的商品
+            found = {sku.id for sku in skus}
+            deleted = [sku_id for sku_id in sku_ids if sku_id not in found]
+            for sku_id in deleted:
+                backend.remove('%s.%d' % (GoodsSKU._meta.label_lower, sku_id))
+            # 同时删除搜索联想，SPU已经没有商品时一起删除
+            remove_sku_suggestions(conn, deleted)
+        except Exception:
+            # 更新失败时放回队列，下次重试
+            conn.sadd(SEARCH_INDEX_QUEUE_KEY, *sku_ids)
+            raise
+        updated += len(sku_ids)
@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from apps.goods.models import GoodsSKU
+
+# 商品信息的缓存：进程内LRU缓存 -> redis -> mysql
+# 缓存中商品的库存和销量可能不是最新的，只能用于展示和预校验，下单时以mysql中的库存为准
+SKU_CACHE_KEY = 'sku_%d'
+
+# 缓存的字段
+FIELD_NAMES = [field.attname for field in GoodsSKU._meta.concrete_fields]
+
+
+class LocalLRUCache(object):
+    '''进程内的LRU缓存，每条数据有过期时间，线程安全'''
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            expire, value = item
+            if expire < time.time():
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.time() + self.timeout, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+local_cache = LocalLRUCache(settings.SKU_LOCAL_CACHE_SIZE, settings.SKU_LOCAL_CACHE_TIMEOUT)
+
+
+def _to_int(sku_id):
+    try:
+        return int(sku_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _build(values):
+    # 每次返回新的对象，视图中给sku动态增加的属性不会影响缓存
+    return GoodsSKU.from_db('default', FIELD_NAMES, values)
+
+
+def get_many_skus(sku_ids):
+    '''批量获取商品信息，返回 {商品id: sku}，不存在的商品不在结果中
+
+    依次查询进程内缓存、redis(一次mget)、mysql(一次id__in查询)
+    '''
+    ids = [sku_id for sku_id in map(_to_int, sku_ids) if sku_id is not None]
+
+    skus = {}
+    missing = []
+    for sku_id in ids:
+        values = local_cache.get(sku_id)
+        if values is None:
+            missing.append(sku_id)
+        else:
+            skus[sku_id] = _build(values)
+    if not missing:
+        return skus
+
+    cached = cache.get_many([SKU_CACHE_KEY % sku_id for sku_id in missing])
+    db_ids = []
+    for sku_id in missing:
+        values = cached.get(SKU_CACHE_KEY % sku_id)
+        if values is None:
+            db_ids.append(sku_id)
+        else:
+            local_cache.set(sku_id, values)
+            skus[sku_id] = _build(values)
+    if not db_ids:
+        return skus
+
+    _load_from_db(db_ids, skus)
+    return skus
+
+
+def _load_from_db(sku_ids, skus):
+    # 一次从mysql查询缓存中没有的商品，放入缓存
+    to_cache = {}
+    for values in GoodsSKU.objects.filter(id__in=sku_ids).values_list(*FIELD_NAMES):
+        sku = _build(values)
+        local_cache.set(sku.id, values)
+        to_cache[SKU_CACHE_KEY % sku.id] = values
+        skus[sku.id] = sku
+    if to_cache:
+        cache.set_many(to_cache, settings.SKU_CACHE_TIMEOUT)
+
+
+def sku_cache_key_prefix():
+    '''商品缓存在redis中的key前缀(包含django缓存的前缀和版本号)，在lua脚本中拼接商品id直接读取缓存'''
+    return cache.make_key(SKU_CACHE_KEY.replace('%d', ''))
+
+
+def get_skus_from_raw(sku_ids, raw_values):
+    '''根据lua脚本从redis中直接读出的缓存数据获取商品信息，返回 {商品id: sku}
+
+    raw_values和sku_ids一一对应，没有缓存的商品一次从mysql查询
+    '''
+    skus = {}
+    db_ids = []
+    for sku_id, raw in zip(map(_to_int, sku_ids), raw_values):
+        if sku_id is None:
+            continue
+        if raw is None:
+            db_ids.append(sku_id)
+        else:
+            skus[sku_id] = _build(cache.client.decode(raw))
+    if db_ids:
+        _load_from_db(db_ids, skus)
+    return skus
+
+
+def get_sku(sku_id):
+    '''获取一个商品的信息，商品不存在时返回None'''
+    return get_many_skus([sku_id]).get(_to_int(sku_id))
+
+
+def invalidate_sku(sku_id):
+    '''商品修改或删除后清除缓存，其他进程的进程内缓存在SKU_LOCAL_CACHE_TIMEOUT秒后过期'''
+    local_cache.delete(sku_id)
+    cache.delete(SKU_CACHE_KEY % sku_id)
+
+
+def sku_changed(sender, instance, **kwargs):
+    '''GoodsSKU的post_save和post_delete信号处理函数'''
+    # 事务提交后再清除，否则并发的请求可能在提交前把修改前的数据重新缓存
+    transaction.on_commit(partial(invalidate_sku, instance.id))
@@ -0,0 +1,165 @@
+from django.conf import settings
+from django.db.models import Sum
+
+from apps.goods.models import Goods, GoodsSKU
+
+# 搜索联想：商品名称和SPU名称的每个前缀对应一个有序集合，成员按销量排序
+# 前缀 -> {成员: 销量}，成员为 s:商品id 或 g:SPU id
+SUGGEST_PREFIX_KEY = 'suggest_%s'
+# 成员 -> 显示的名称，名称修改时用于找到原来的前缀
+SUGGEST_TERMS_KEY = 'suggest_terms'
+# 商品id -> SPU id，商品删除或换了SPU后用于找到原来的SPU
+SUGGEST_SKU_GOODS_KEY = 'suggest_sku_goods'
+
+# 按销量从高到低获取前缀对应的名称，一次redis请求
+# KEYS: 前缀的有序集合, 名称
+# ARGV: 获取的条数
+SUGGEST_SCRIPT = '''
+local members = redis.call('ZREVRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #members == 0 then
+    return {}
+end
+return redis.call('HMGET', KEYS[2], unpack(members))
+'''
+
+
+def _normalize(name):
+    return name.strip().lower()
+
+
+def _prefixes(name):
+    '''名称的所有前缀，最长SUGGEST_MAX_PREFIX_LENGTH个字'''
+    name = _normalize(name)
+    return [name[:i] for i in range(1, min(len(name), settings.SUGGEST_MAX_PREFIX_LENGTH) + 1)]
+
+
+def _write(conn, entries, sku_goods=None):
+    '''写入联想数据 entries: {成员: (名称, 销量)}，名称修改时从原来的前缀中移除，sku_goods: {商品id: SPU id}'''
+    if not entries:
+        return
+    members = list(entries)
+    old_names = conn.hmget(SUGGEST_TERMS_KEY, members)
+
+    pipe = conn.pipeline()
+    for member, old_name in zip(members, old_names):
+        name, score = entries[member]
+        if old_name is not None and old_name.decode() != name:
+            for prefix in _prefixes(old_name.decode()):
+                pipe.zrem(SUGGEST_PREFIX_KEY % prefix, member)
+        for prefix in _prefixes(name):
+            pipe.execute_command('ZADD', SUGGEST_PREFIX_KEY % prefix, score, member)
+        pipe.hset(SUGGEST_TERMS_KEY, member, name)
+    for sku_id, goods_id in (sku_goods or {}).items():
+        pipe.hset(SUGGEST_SKU_GOODS_KEY, sku_id, goods_id)
+    pipe.execute()
+
+
+def remove_suggestions(conn, members):
+    '''删除联想数据'''
+    members = list(members)
+    if not members:
+        return
+    names = conn.hmget(SUGGEST_TERMS_KEY, members)
+    pipe = conn.pipeline()
+    for member, name in zip(members, names):
+        if name is None:
+            continue
+        for prefix in _prefixes(name.decode()):
+            pipe.zrem(SUGGEST_PREFIX_KEY % prefix, member)
+    pipe.hdel(SUGGEST_TERMS_KEY, *members)
+    pipe.execute()
+
+
+def _goods_entries(goods_ids):
+    # SPU的权重为所有商品的销量之和，没有商品的SPU不在联想中
+    sales = dict(GoodsSKU.objects.filter(goods_id__in=goods_ids).values('goods_id')
+                 .annotate(sales=Sum('sales')).values_list('goods_id', 'sales'))
+    names = dict(Goods.objects.filter(id__in=sales).values_list('id', 'name'))
+    return {'g:%d' % goods_id: (name, sales[goods_id] or 0) for goods_id, name in names.items()}
+
+
+def _sku_goods(conn, sku_ids):
+    # 联想数据中记录的商品所属的SPU id
+    return {int(goods_id) for goods_id in conn.hmget(SUGGEST_SKU_GOODS_KEY, list(sku_ids)) if goods_id is not None}
+
+
+def _empty_goods(goods_ids, entries):
+    # 已经没有商品的SPU
+    return ['g:%d' % goods_id for goods_id in goods_ids if 'g:%d' % goods_id not in entries]
+
+
+def update_suggestions(conn, skus):
+    '''商品修改后更新联想数据，包括商品所属的SPU，商品换了SPU时更新原来的SPU'''
+    sku_goods = {sku.id: sku.goods_id for sku in skus}
+    goods_ids = set(sku_goods.values()) | _sku_goods(conn, sku_goods)
+    entries = {'s:%d' % sku.id: (sku.name, sku.sales) for sku in skus}
+    entries.update(_goods_entries(goods_ids))
+    _write(conn, entries, sku_goods)
+    remove_suggestions(conn, _empty_goods(goods_ids, entries))
+
+
+def remove_sku_suggestions(conn, sku_ids):
+    '''商品删除后删除联想数据，所属的SPU没有商品时一起删除，否则更新SPU的销量权重'''
+    sku_ids = list(sku_ids)
+    if not sku_ids:
+        return
+    goods_ids = _sku_goods(conn, sku_ids)
+    entries = _goods_entries(goods_ids) if goods_ids else {}
+    remove_suggestions(conn, ['s:%d' % sku_id for sku_id in sku_ids] + _empty_goods(goods_ids, entries))
+    conn.hdel(SUGGEST_SKU_GOODS_KEY, *sku_ids)
+    _write(conn, entries)
+
+
+def rebuild_suggestions(conn, batch_size=1000):
+    '''按id顺序分批重建所有商品的联想数据，同时刷新销量权重，删除已经不存在的商品和没有商品的SPU，返回写入的条数'''
+    members = set()
+    sku_ids = set()
+    last_id = 0
+    while True:
+        rows = list(GoodsSKU.objects.filter(id__gt=last_id).order_by('id')
+                    .values_list('id', 'name', 'sales', 'goods_id')[:batch_size])
+        if not rows:
+            break
+        entries = {'s:%d' % sku_id: (name, sales) for sku_id, name, sales, goods_id in rows}
+        sku_goods = {sku_id: goods_id for sku_id, name, sales, goods_id in rows}
+        _write(conn, entries, sku_goods)
+        members.update(entries)
+        sku_ids.update(sku_goods)
+        last_id = rows[-1][0]
+
+    goods_ids = list(Goods.objects.values_list('id', flat=True))
+    for i in range(0, len(goods_ids), batch_size):
+        entries = _goods_entries(goods_ids[i:i + batch_size])
+        _write(conn, entries)
+        members.update(entries)
+
+    stale = [member for member in (m.decode() for m in conn.hkeys(SUGGEST_TERMS_KEY)) if member not in members]
+    remove_suggestions(conn, stale)
+    stale_skus = [sku_id for sku_id in conn.hkeys(SUGGEST_SKU_GOODS_KEY) if int(sku_id) not in sku_ids]
+    if stale_skus:
+        conn.hdel(SUGGEST_SKU_GOODS_KEY, *stale_skus)
+    return len(members)
+
+
+def suggest(conn, query, limit=None):
+    '''获取以query开头的名称，按销量从高到低排序，名称相同的只返回一个'''
+    limit = limit or settings.SUGGEST_LIMIT
+    query = _normalize(query)
+    if not query:
+        return []
+    # 超过最长前缀时用最长前缀查询，再按完整的关键字过滤
+    prefix = query[:settings.SUGGEST_MAX_PREFIX_LENGTH]
+    count = limit * 2 if len(query) > len(prefix) else limit + 5
+    names = conn.register_script(SUGGEST_SCRIPT)(
+        keys=[SUGGEST_PREFIX_KEY % prefix, SUGGEST_TERMS_KEY], args=[count])
+
+    suggestions = []
+    for name in names:
+        if name is None:
+            continue
+        name = name.decode()
+        if name not in suggestions and _normalize(name).startswith(query):
+            suggestions.append(name)
+            if len(suggestions) >= limit:
+                break
+    return suggestions
@@ -1,3 +1,369 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
 
-# Create your tests here.
+import redis
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from django.template import loader
+from django.test import SimpleTestCase, TestCase, override_settings
+from haystack import connections
+
+from apps.goods.loaders import bump_index_data_version, get_index_data, load_index_data
+from apps.goods.models import *
+from apps.goods.search import search_skus
+from apps.goods.search_queue import QueuedSignalProcessor, remember_indexed_values
+from apps.goods.sku_cache import get_many_skus, get_sku, invalidate_sku
+from apps.goods.suggest import (SUGGEST_SKU_GOODS_KEY, _prefixes, remove_sku_suggestions, suggest,
+                                 update_suggestions)
+from apps.goods.whoosh_backend import SORTABLE_FIELDS, SortableWhooshSearchBackend
+from apps.orders.models import OrderGoods, OrderInfo
+from apps.users.models import Address
+from utils.pagination import keyset_paginate
+
+
+class GoodsDataMixin(object):
+    '''创建测试用的商品SPU、种类和商品'''
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.goods = Goods.objects.create(name='草莓')
+
+    @classmethod
+    def create_type(cls, i=0):
+        return GoodsType.objects.create(name='种类%d' % i, logo='fruit', image='type/%d.jpg' % i)
+
+    @classmethod
+    def create_sku(cls, type, i, **kwargs):
+        fields = {'name': '商品%d' % i, 'desc': '简介', 'price': '10.00', 'unite': '500g', 'image': 'goods/%d.jpg' % i}
+        fields.update(kwargs)
+        return GoodsSKU.objects.create(type=type, goods=cls.goods, **fields)
+
+
+# 测试使用进程内缓存，不依赖redis，也不覆盖开发环境redis中的数据
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class IndexDataTest(GoodsDataMixin, TestCase):
+    '''首页数据查询次数测试'''
+    # 首页数据固定的查询次数：种类、轮播、促销活动、分类商品展示
+    INDEX_QUERY_BUDGET = 4
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in range(6):
+            type = cls.create_type(i)
+            for j in range(4):
+                sku = cls.create_sku(type, j, name='商品%d-%d' % (i, j))
+                IndexTypeGoodsBanner.objects.create(type=type, sku=sku, display_type=j % 2, index=j)
+            IndexGoodsBanner.objects.create(sku=sku, image='banner/%d.jpg' % i, index=i)
+        IndexPromotionBanner.objects.create(name='活动', url='#', image='banner/promotion.jpg')
+
+    def test_load_index_data_query_budget(self):
+        with self.assertNumQueries(self.INDEX_QUERY_BUDGET):
+            context = load_index_data()
+
+        types = context['types']
+        self.assertEqual(len(types), 6)
+        for type in types:
+            self.assertEqual([banner.index for banner in type.image_banners], [1, 3])
+            self.assertEqual([banner.index for banner in type.title_banners], [0, 2])
+            self.assertTrue(all(banner.type_id == type.id for banner in type.image_banners))
+
+    def test_render_index_query_budget(self):
+        # 渲染模板时访问banner.sku不能再产生查询
+        with self.assertNumQueries(self.INDEX_QUERY_BUDGET):
+            context = load_index_data()
+            context['cart_count'] = 0
+            loader.get_template('index.html').render(context)
+
+    def test_index_data_cache_version(self):
+        bump_index_data_version()
+        with self.assertNumQueries(self.INDEX_QUERY_BUDGET):
+            get_index_data()
+        # 版本号未变化时直接读取缓存
+        with self.assertNumQueries(0):
+            context = get_index_data()
+        self.assertEqual(len(context['types']), 6)
+
+        # 修改数据后版本号加1，缓存失效
+        GoodsType.objects.create(name='新种类', logo='fruit', image='type/new.jpg')
+        bump_index_data_version()
+        with self.assertNumQueries(self.INDEX_QUERY_BUDGET):
+            context = get_index_data()
+        self.assertEqual(len(context['types']), 7)
+
+
+class KeysetPaginationTest(GoodsDataMixin, TestCase):
+    '''列表页键集分页测试'''
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.type = cls.create_type()
+        # 价格和销量有重复，验证按id区分顺序
+        for i in range(12):
+            cls.create_sku(cls.type, i, price='%d.50' % (i % 4), sales=i % 3)
+
+    def walk(self, ordering, per_page):
+        skus = GoodsSKU.objects.filter(type=self.type)
+        page = keyset_paginate(skus, ordering, per_page, 1)
+        pages = [page]
+        while page.has_next():
+            page = keyset_paginate(skus, ordering, per_page, page.next_page_number(), page.next_cursor)
+            pages.append(page)
+        return pages
+
+    def test_forward_matches_offset(self):
+        for ordering in (['id'], ['price', 'id'], ['-sales', '-id']):
+            expected = list(GoodsSKU.objects.filter(type=self.type).order_by(*ordering))
+            pages = self.walk(ordering, 5)
+            self.assertEqual([len(page) for page in pages], [5, 5, 2])
+            self.assertEqual([sku for page in pages for sku in page], expected)
+
+    def test_backward(self):
+        skus = GoodsSKU.objects.filter(type=self.type)
+        ordering = ['-sales', '-id']
+        pages = self.walk(ordering, 5)
+        last = pages[-1]
+        page = keyset_paginate(skus, ordering, 5, last.previous_page_number(), last.previous_cursor)
+        self.assertEqual(list(page), list(pages[1]))
+        self.assertTrue(page.has_previous())
+        self.assertTrue(page.has_next())
+        page = keyset_paginate(skus, ordering, 5, page.previous_page_number(), page.previous_cursor)
+        self.assertEqual(list(page), list(pages[0]))
+        self.assertFalse(page.has_previous())
+
+    def test_invalid_cursor_falls_back_to_offset(self):
+        skus = GoodsSKU.objects.filter(type=self.type)
+        page = keyset_paginate(skus, ['id'], 5, 2, 'not-a-cursor')
+        self.assertEqual(list(page), list(skus.order_by('id')[5:10]))
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', '查询计划测试使用sqlite: DJANGO_TEST_SQLITE=1 python manage.py test')
+class QueryPlanTest(TestCase):
+    '''列表页、详情页、订单页的热点查询都要使用索引，不能全表扫描'''
+    def assertUsesIndex(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        table = queryset.model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[-1] for row in cursor.fetchall()]
+        for detail in plan:
+            # SCAN df_goods_sku / SCAN TABLE df_goods_sku [USING INDEX ...] 都是全表(全索引)扫描
+            self.assertNotRegex(detail, r'^SCAN (TABLE )?%s\b' % table, '\n'.join([sql] + plan))
+        self.assertTrue(any(detail.startswith('SEARCH') for detail in plan), '\n'.join([sql] + plan))
+
+    def test_list_queries(self):
+        skus = GoodsSKU.objects.filter(type_id=1)
+        self.assertUsesIndex(skus.order_by('id')[:6])
+        self.assertUsesIndex(skus.order_by('price', 'id')[:6])
+        self.assertUsesIndex(skus.order_by('-sales', '-id')[:6])
+        self.assertUsesIndex(skus.order_by('-create_time')[:2])
+        # 键集分页的定位查询
+        self.assertUsesIndex(skus.filter(Q(price__gt='9.90') | Q(price='9.90', id__gt=10)).order_by('price', 'id')[:6])
+
+    def test_detail_queries(self):
+        self.assertUsesIndex(OrderGoods.objects.filter(sku_id=1).exclude(comment=''))
+        self.assertUsesIndex(GoodsSKU.objects.filter(goods_id=1).exclude(id=1))
+
+    def test_index_type_banner_query(self):
+        self.assertUsesIndex(IndexTypeGoodsBanner.objects.filter(type_id=1, display_type=1).order_by('index'))
+
+    def test_user_queries(self):
+        self.assertUsesIndex(OrderInfo.objects.filter(user_id=1).order_by('-create_time', '-order_id')[:2])
+        self.assertUsesIndex(Address.objects.filter(user_id=1, is_default=True))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SkuCacheTest(GoodsDataMixin, TestCase):
+    '''商品缓存测试'''
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        type = cls.create_type()
+        cls.skus = [cls.create_sku(type, i) for i in range(3)]
+
+    def setUp(self):
+        for sku in self.skus:
+            invalidate_sku(sku.id)
+
+    def test_read_through(self):
+        ids = [sku.id for sku in self.skus]
+        with self.assertNumQueries(1):
+            skus = get_many_skus(ids + [0, 'x'])
+        self.assertEqual(sorted(skus), ids)
+        with self.assertNumQueries(0):
+            sku = get_sku(ids[0])
+        self.assertEqual(sku.name, '商品0')
+        # 返回的是新对象，修改不影响缓存
+        sku.count = 3
+        self.assertFalse(hasattr(get_sku(ids[0]), 'count'))
+
+    def run_invalidate_callbacks(self):
+        # TestCase中事务不会提交，手动执行清除缓存的回调
+        for sids, func in connection.run_on_commit:
+            if getattr(func, 'func', None) is invalidate_sku:
+                func()
+
+    def test_invalidate_on_save_and_delete(self):
+        sku = self.skus[0]
+        get_sku(sku.id)
+        sku.name = '新名称'
+        sku.save()
+        # 事务提交前缓存不变
+        self.assertEqual(get_sku(sku.id).name, '商品0')
+        self.run_invalidate_callbacks()
+        self.assertEqual(get_sku(sku.id).name, '新名称')
+        sku.delete()
+        self.run_invalidate_callbacks()
+        self.assertIsNone(get_sku(sku.id))
+
+
+class QueuedSignalProcessorTest(SimpleTestCase):
+    '''只修改不在索引中的字段时不放入索引更新队列'''
+    def handle_save(self, sku, **kwargs):
+        with mock.patch('apps.goods.search_queue.enqueue_skus') as enqueue_skus:
+            QueuedSignalProcessor.handle_save(None, GoodsSKU, sku, **kwargs)
+        return enqueue_skus.called
+
+    def test_update_fields(self):
+        sku = GoodsSKU(id=1, name='草莓', stock=5, sales=0)
+        remember_indexed_values(GoodsSKU, sku)
+        sku.name = '蓝莓'
+        # 只保存了不在索引中的字段，不比较快照
+        self.assertFalse(self.handle_save(sku, update_fields=frozenset(['update_time'])))
+        self.assertTrue(self.handle_save(sku, update_fields=frozenset(['name', 'update_time'])))
+        # 库存只在有货和无货之间变化时更新索引
+        sku.stock = 4
+        self.assertFalse(self.handle_save(sku, update_fields=frozenset(['stock'])))
+        sku.stock = 0
+        self.assertTrue(self.handle_save(sku, update_fields=frozenset(['stock'])))
+
+
+class SuggestPrefixTest(SimpleTestCase):
+    '''搜索联想前缀测试'''
+    @override_settings(SUGGEST_MAX_PREFIX_LENGTH=3)
+    def test_prefixes(self):
+        self.assertEqual(_prefixes(' Apple草莓 '), ['a', 'ap', 'app'])
+        self.assertEqual(_prefixes('草莓'), ['草', '草莓'])
+        self.assertEqual(_prefixes(''), [])
+
+
+# 搜索联想测试使用单独的redis库，每个测试前清空: TEST_REDIS_URL=redis://127.0.0.1:6379/15
+test_redis = redis.StrictRedis.from_url(os.environ.get('TEST_REDIS_URL', 'redis://127.0.0.1:6379/15'))
+
+
+def redis_available():
+    try:
+        return test_redis.ping()
+    except redis.ConnectionError:
+        return False
+
+
+@unittest.skipUnless(redis_available(), '搜索联想测试需要redis: TEST_REDIS_URL')
+@override_settings(CACHES=LOCMEM_CACHES)
+class SuggestTest(GoodsDataMixin, TestCase):
+    '''搜索联想的SPU随商品删除和更换测试'''
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        type = cls.create_type()
+        cls.skus = [cls.create_sku(type, i, name='草莓%d' % i, sales=i) for i in range(2)]
+
+    def setUp(self):
+        self.conn = test_redis
+        self.conn.flushdb()
+        update_suggestions(self.conn, self.skus)
+
+    def test_remove_goods_with_last_sku(self):
+        self.assertCountEqual(suggest(self.conn, '草莓'), ['草莓', '草莓0', '草莓1'])
+        GoodsSKU.objects.filter(id=self.skus[0].id).delete()
+        remove_sku_suggestions(self.conn, [self.skus[0].id])
+        # SPU还有商品
+        self.assertCountEqual(suggest(self.conn, '草莓'), ['草莓', '草莓1'])
+        GoodsSKU.objects.filter(id=self.skus[1].id).delete()
+        remove_sku_suggestions(self.conn, [self.skus[1].id])
+        # 同一批中删除SPU
+        self.assertEqual(suggest(self.conn, '草莓'), [])
+        self.assertFalse(self.conn.exists(SUGGEST_SKU_GOODS_KEY))
+
+    def test_sku_moved_to_other_goods(self):
+        other = Goods.objects.create(name='蓝莓')
+        GoodsSKU.objects.filter(id__in=[sku.id for sku in self.skus]).update(goods=other)
+        update_suggestions(self.conn, GoodsSKU.objects.all())
+        # 原来的SPU已经没有商品
+        self.assertCountEqual(suggest(self.conn, '草莓'), ['草莓0', '草莓1'])
+        self.assertEqual(suggest(self.conn, '蓝'), ['蓝莓'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SearchViewTest(TestCase):
+    '''搜索结果页测试'''
+    def test_page_below_one(self):
+        data = {'results': [], 'count': 0, 'type_counts': {}}
+        with mock.patch('apps.goods.views.search_skus', return_value=data) as search_skus:
+            for page in ('0', '-3'):
+                response = self.client.get('/search/', {'q': '草莓', 'page': page})
+                self.assertEqual(response.status_code, 200)
+                # 页码小于1时按第1页搜索，不传给whoosh
+                self.assertEqual(search_skus.call_args[0][1], 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SearchSkusTest(GoodsDataMixin, TestCase):
+    '''搜索的筛选、排序和种类统计测试，使用临时目录中的索引'''
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.fruit = cls.create_type(0)
+        cls.meat = cls.create_type(1)
+        cls.skus = [cls.create_sku(cls.fruit, 0, price='30.00', sales=50, stock=10),
+                    cls.create_sku(cls.fruit, 1, price='10.00', sales=5, stock=0),
+                    cls.create_sku(cls.meat, 2, price='20.00', sales=20, stock=3)]
+
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.backend = SortableWhooshSearchBackend('default', PATH=path)
+        self.backend.setup()
+        index = connections['default'].get_unified_index().get_index(GoodsSKU)
+        self.backend.update(index, list(GoodsSKU.objects.select_related('goods')))
+
+        handler = {'default': mock.Mock(get_backend=lambda: self.backend)}
+        patcher = mock.patch('apps.goods.search.connections', handler)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+
+    def search(self, **filters):
+        data = search_skus('简介', 1, 10, filters)
+        return [item['id'] for item in data['results']], data['type_counts']
+
+    def test_sortable_columns(self):
+        for name in SORTABLE_FIELDS:
+            self.assertIsNotNone(self.backend.schema[name].column_type, name)
+
+    def test_type_counts(self):
+        ids, type_counts = self.search()
+        self.assertEqual(sorted(ids), [sku.id for sku in self.skus])
+        self.assertEqual(type_counts, {self.fruit.id: 2, self.meat.id: 1})
+        # 选择种类后各种类的商品数不变
+        ids, type_counts = self.search(type_id=self.meat.id)
+        self.assertEqual(ids, [self.skus[2].id])
+        self.assertEqual(type_counts, {self.fruit.id: 2, self.meat.id: 1})
+
+    def test_filters(self):
+        ids, type_counts = self.search(in_stock=True)
+        self.assertEqual(sorted(ids), [self.skus[0].id, self.skus[2].id])
+        self.assertEqual(type_counts, {self.fruit.id: 1, self.meat.id: 1})
+        ids, type_counts = self.search(min_price=15, max_price=25)
+        self.assertEqual(ids, [self.skus[2].id])
+
+    def test_sort(self):
+        self.assertEqual(self.search(sort='price')[0], [self.skus[i].id for i in (1, 2, 0)])
+        self.assertEqual(self.search(sort='hot')[0], [self.skus[i].id for i in (0, 2, 1)])
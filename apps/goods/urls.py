@@ -7,4 +7,6 @@ urlpatterns = [
     path('', IndexView.as_view(), name='index'),
     path('goods/<goods_id>', DetailView.as_view(), name='detail'),
     path('list/<type_id>/<page>', ListView.as_view(), name='list'),
+    path('search/', SearchView.as_view(), name='search'),  # 全文检索
+    path('search/suggest', SuggestView.as_view(), name='suggest'),  # 搜索联想
 ]
@@ -1,51 +1,52 @@
-from django.core.paginator import Paginator
+import math
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.paginator import Page, Paginator
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render, redirect
 from django.urls import reverse
 from django.views import View
-from apps.goods.models import *
 from django_redis import get_redis_connection
+from apps.goods.loaders import get_index_data, get_type_sku_count
+from apps.goods.models import *
+from apps.goods.search import search_skus
+from apps.goods.suggest import suggest
+from apps.goods.sku_cache import get_sku
 
+from apps.cart.anonymous import has_anonymous_cart, load_anonymous_cart
+from apps.cart.store import get_cart_store
 from apps.orders.models import *
+from utils.pagination import keyset_paginate
 
 
 class IndexView(View):
     '''首页'''
     def get(self, request):
-        # 获取商品种类信息
-        types = GoodsType.objects.all()
-
-        # 获取首页轮播商品信息
-        goods_banners = IndexGoodsBanner.objects.all().order_by('index')
-
-        # 获取首页促销活动信息
-        promotion_banners = IndexPromotionBanner.objects.all().order_by('index')
-
-        # 获取首页分类商品展示信息
-        for type in types:  # GoodsType
-            # 获取type种类首页分类商品的图片展示信息
-            image_banners = IndexTypeGoodsBanner.objects.filter(type=type, display_type=1).order_by('index')
-            # 获取type种类首页分类商品的文字展示信息
-            title_banners = IndexTypeGoodsBanner.objects.filter(type=type, display_type=0).order_by('index')
-
-            # 动态给type增加属性，分别保存首页分类商品的图片展示信息和文字展示信息
-            type.image_banners = image_banners
-            type.title_banners = title_banners
+        # 未登录用户直接返回celery生成的首页静态页面，不访问数据库
+        # 静态页面中购物车数目为0，cookie中有购物车的未登录用户动态生成首页
+        if not request.user.is_authenticated and not has_anonymous_cart(request):
+            try:
+                with open(settings.STATIC_INDEX_PATH, encoding='utf8') as f:
+                    return HttpResponse(f.read())
+            except FileNotFoundError:
+                # 静态页面还未生成，动态生成首页
+                pass
+
+        # 获取首页的种类、轮播、促销活动和分类商品展示信息(与用户无关，从缓存中读取)
+        context = get_index_data()
 
         # 获取用户购物车中商品的数目
         user = request.user
         if user.is_authenticated:
             # 用户已登陆
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            cart_count = conn.hlen(cart_key)
+            cart_count = get_cart_store().count(user.id)
         else:
-            cart_count = 0
+            # 未登录用户的购物车在cookie中
+            cart_count = len(load_anonymous_cart(request))
 
         # 组织模板上下文
-        context = {'types': types,
-                   'goods_banners': goods_banners,
-                   'promotion_banners': promotion_banners,
-                   'cart_count': cart_count}
+        context['cart_count'] = cart_count
 
         return render(request, 'index.html', context=context)
 
@@ -53,9 +54,9 @@ class IndexView(View):
 class DetailView(View):
     '''详情页'''
     def get(self, request, goods_id):
-        try:
-            sku = GoodsSKU.objects.get(id=goods_id)
-        except GoodsSKU.DoesNotExist:
+        # 从缓存中获取商品信息
+        sku = get_sku(goods_id)
+        if sku is None:
             # 商品不存在
             return redirect(reverse('goods:index'))
 
@@ -66,29 +67,20 @@ class DetailView(View):
         sku_orders = OrderGoods.objects.filter(sku=sku).exclude(comment='')
 
         # 获取新品信息
-        new_skus = GoodsSKU.objects.filter(type=sku.type).order_by('-create_time')[:2]
+        new_skus = GoodsSKU.objects.filter(type_id=sku.type_id).order_by('-create_time')[:2]
 
         # 获取同一个SPU的其他规格商品
-        same_spu_skus = GoodsSKU.objects.filter(goods=sku.goods).exclude(id=goods_id)
+        same_spu_skus = GoodsSKU.objects.filter(goods_id=sku.goods_id).exclude(id=sku.id)
 
         # 获取用户购物车中商品的数目
         user = request.user
-        cart_count = 0
         if user.is_authenticated:
             # 用户已登陆
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            cart_count = conn.hlen(cart_key)
-
-            # 添加用户历史记录
-            conn = get_redis_connection('default')
-            history_key = 'history_%d' % user.id
-            # 移除列表中的goods_id
-            conn.lrem(history_key, 0, goods_id)
-            # 把goods_id插入到列表的左侧
-            conn.lpush(history_key, goods_id)
-            # 只保存用户最新浏览的5条信息
-            conn.ltrim(history_key, 0, 4)
+            # 获取购物车条目数的同时添加用户历史记录，一次redis请求
+            cart_count = get_cart_store().count_and_add_history(user.id, sku.id)
+        else:
+            # 未登录用户的购物车在cookie中
+            cart_count = len(load_anonymous_cart(request))
 
         # 组织模板上下文
         context = {'sku': sku,
@@ -107,6 +99,9 @@ class DetailView(View):
 # /list/种类id/页码?sort=排序方式
 class ListView(View):
     '''列表页'''
+    # 每页显示的商品数
+    per_page = 5
+
     def get(self, request, type_id, page):
         # 先获取种类信息
         try:
@@ -122,17 +117,16 @@ class ListView(View):
         # sort=default 按照默认id排序
         # sort=price按照商品价格排序
         # sort=hot按照商品销量排序
+        # 排序字段最后加上id，保证顺序唯一，用于键集分页，排序方向和(type, 字段, id)索引一致
         sort = request.GET.get('sort')
         if sort == 'price':
-            skus = GoodsSKU.objects.filter(type=type).order_by('price')
+            ordering = ['price', 'id']
         elif sort == 'hot':
-            skus = GoodsSKU.objects.filter(type=type).order_by('-sales')
+            ordering = ['-sales', '-id']
         else:
             sort = 'default'
-            skus = GoodsSKU.objects.filter(type=type).order_by('id')
-
-        # 对数据进行分页
-        paginator = Paginator(skus, 5)
+            ordering = ['id']
+        skus = GoodsSKU.objects.filter(type=type)
 
         # 获取第page页的内容
         try:
@@ -140,18 +134,23 @@ class ListView(View):
         except Exception as e:
             page = 1
 
-        if page > paginator.num_pages:
+        # 计算总页数，种类的商品数量保存在缓存中，不用每次都count
+        num_pages = max(1, math.ceil(get_type_sku_count(type.id) / self.per_page))
+
+        # 相邻页面之间通过游标定位(键集分页)，深页面的查询代价和第一页相同
+        cursor = request.GET.get('cursor')
+        if page > num_pages or page < 1:
             page = 1
+            cursor = None
 
         # 获取第page页的Page实例对象
-        skus_page = paginator.page(page)
+        skus_page = keyset_paginate(skus, ordering, self.per_page, page, cursor)
 
         # todo：进行页码的控制，页面上最多显示5个页码
         # 1.总页数小于5页，页面上显示所有页码
         # 2.如果当前页是前3页，显示1-5页
         # 3.如果当前页是后3页，显示后5页
         # 4.其他情况，希纳是当前页的前2页，当前页，当前页的后2页
-        num_pages = paginator.num_pages
         if num_pages < 5:
             pages = range(1, num_pages+1)
         elif page <=3:
@@ -166,12 +165,12 @@ class ListView(View):
 
         # 获取用户购物车中商品的数目
         user = request.user
-        cart_count = 0
         if user.is_authenticated:
             # 用户已登陆
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            cart_count = conn.hlen(cart_key)
+            cart_count = get_cart_store().count(user.id)
+        else:
+            # 未登录用户的购物车在cookie中
+            cart_count = len(load_anonymous_cart(request))
 
         # 组织模板上下文
         context = {'type': type,
@@ -183,3 +182,91 @@ class ListView(View):
                    'sort': sort}
 
         return render(request, 'list.html', context)
+
+
+# /search?q=关键字&page=页码
+class SearchView(View):
+    '''搜索结果页'''
+    def get(self, request):
+        query = request.GET.get('q', '').strip()
+
+        # 获取第page页的内容
+        try:
+            page = int(request.GET.get('page', 1))
+        except Exception as e:
+            page = 1
+        # whoosh不支持小于1的页码
+        if page < 1:
+            page = 1
+        per_page = settings.HAYSTACK_SEARCH_RESULTS_PER_PAGE
+
+        # 获取筛选条件和排序方式
+        # type=种类id  price_min/price_max=价格区间  in_stock=1只看有货
+        # sort=default 按照相关度排序  sort=price按照商品价格排序  sort=hot按照商品销量排序
+        filters = {'type_id': self.get_number(request, 'type', int),
+                   'min_price': self.get_number(request, 'price_min', float),
+                   'max_price': self.get_number(request, 'price_max', float),
+                   'in_stock': request.GET.get('in_stock') == '1' or None,
+                   'sort': request.GET.get('sort') if request.GET.get('sort') in ('price', 'hot') else None}
+
+        # 搜索结果从缓存或索引的存储字段中获取，不查询商品表
+        empty = {'results': [], 'count': 0, 'type_counts': {}}
+        data = search_skus(query, page, per_page, filters) if query else empty
+        paginator = Paginator(range(data['count']), per_page)
+        if page > paginator.num_pages:
+            page = 1
+            data = search_skus(query, page, per_page, filters) if query else empty
+
+        # 各种类的搜索结果数，种类信息从首页数据的缓存中获取
+        types = []
+        for type in get_index_data()['types']:
+            if type.id in data['type_counts']:
+                types.append({'id': type.id, 'name': type.name, 'count': data['type_counts'][type.id]})
+
+        # 翻页、排序等链接中保留的参数
+        params = {'q': query, 'type': filters['type_id'], 'price_min': filters['min_price'],
+                  'price_max': filters['max_price'], 'in_stock': 1 if filters['in_stock'] else None}
+        params = {key: value for key, value in params.items() if value is not None}
+        if filters['sort']:
+            params['sort'] = filters['sort']
+
+        # 组织模板上下文
+        context = {'query': query,
+                   'page': Page(data['results'], page, paginator),
+                   'paginator': paginator,
+                   'types': types,
+                   'filters': filters,
+                   'sort': filters['sort'] or 'default',
+                   'search_params': urlencode(params),
+                   'sort_params': self.params_without(params, 'sort'),
+                   'type_params': self.params_without(params, 'type'),
+                   'stock_params': self.params_without(params, 'in_stock')}
+
+        return render(request, 'search/search.html', context)
+
+    def get_number(self, request, name, convert):
+        '''获取数字参数，不存在或不合法时返回None'''
+        try:
+            value = convert(request.GET[name])
+        except (KeyError, ValueError):
+            return None
+        return value if math.isfinite(value) else None
+
+    def params_without(self, params, name):
+        '''去掉一个参数后的链接参数'''
+        return urlencode({key: value for key, value in params.items() if key != name})
+
+
+# /search/suggest?q=关键字
+class SuggestView(View):
+    '''搜索联想'''
+    def get(self, request):
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return JsonResponse({'res': 0, 'errmsg': '数据不完整'})
+
+        # 从redis的前缀索引中获取，按销量排序
+        conn = get_redis_connection('default')
+        suggestions = suggest(conn, query)
+
+        return JsonResponse({'res': 1, 'suggestions': suggestions})
@@ -0,0 +1,118 @@
+from decimal import Decimal
+
+from django.db.models import Case, F, IntegerField, Q, Value, When
+
+from apps.goods.models import GoodsSKU
+from apps.goods.search_queue import enqueue_skus
+from apps.orders.models import OrderGoods
+
+
+class OrderCommitError(Exception):
+    '''订单创建失败，res和errmsg直接返回给前端'''
+    def __init__(self, res, errmsg):
+        super().__init__(errmsg)
+        self.res = res
+        self.errmsg = errmsg
+
+
+class StockConflict(Exception):
+    '''乐观锁更新库存时，商品库存已被其他订单修改'''
+    def __init__(self, skus):
+        super().__init__('库存冲突')
+        # 本次读取到的商品，用于找出库存被修改的商品
+        self.skus = skus
+
+
+def get_order_counts(cart_store, user_id, sku_ids):
+    '''一次从购物车中获取商品的数量，返回 {商品id: 数量}'''
+    try:
+        ids = [int(sku_id) for sku_id in sku_ids]
+    except ValueError:
+        raise OrderCommitError(4, '商品不存在')
+
+    counts = cart_store.items(user_id, ids)
+    if len(counts) != len(set(ids)):
+        # 有商品不在购物车中
+        raise OrderCommitError(4, '商品不存在')
+    return counts
+
+
+def sku_count_case(counts):
+    # CASE id WHEN 1 THEN 2 WHEN 3 THEN 1 ... END，每个商品对应购买的数量
+    whens = [When(id=sku_id, then=Value(count)) for sku_id, count in counts.items()]
+    return Case(*whens, default=Value(0), output_field=IntegerField())
+
+
+def _check_stock(skus, counts):
+    # 校验商品是否存在以及商品的库存
+    if len(skus) != len(counts):
+        raise OrderCommitError(4, '商品不存在')
+    for sku in skus:
+        if counts[sku.id] > sku.stock:
+            raise OrderCommitError(5, '商品库存不足')
+
+
+def _create_order_goods(order, skus, counts):
+    # 一条insert语句向df_order_goods表中加入所有记录，并计算订单商品的总数量和总价格
+    total_count = 0
+    total_price = Decimal('0')
+    order_goods = []
+    for sku in skus:
+        count = counts[sku.id]
+        order_goods.append(OrderGoods(order=order, sku=sku, count=count, price=sku.price))
+        total_count += count
+        total_price += sku.price*count
+    OrderGoods.objects.bulk_create(order_goods)
+
+    # 更新订单信息表中的商品的总数量和总价格
+    order.total_count = total_count
+    order.total_price = total_price
+    order.save(update_fields=['total_count', 'total_price'])
+
+
+def commit_order_locked(order, counts):
+    '''悲观锁：按id顺序一次锁定订单的所有商品，一条update语句更新库存和销量，需要在事务中调用'''
+    # select * from df_goods_sku where id in (...) order by id for update
+    # 所有订单都按id顺序加锁，避免死锁
+    skus = list(GoodsSKU.objects.select_for_update().filter(id__in=counts).order_by('id'))
+    _check_stock(skus, counts)
+
+    # update df_goods_sku set stock=stock-CASE..., sales=sales+CASE... where id in (...)
+    case = sku_count_case(counts)
+    GoodsSKU.objects.filter(id__in=counts).update(stock=F('stock') - case, sales=F('sales') + case)
+    # 销量和是否有货在搜索索引中，事务提交后放入索引更新队列
+    enqueue_skus(counts)
+
+    _create_order_goods(order, skus, counts)
+
+
+def commit_order_optimistic(order, counts):
+    '''乐观锁：不加锁读取商品，一条带原库存条件的update语句更新库存和销量，需要在事务中调用
+
+    库存已被其他订单修改时抛出StockConflict，调用者需要回滚到调用前的保存点后重试
+    '''
+    skus = list(GoodsSKU.objects.filter(id__in=counts).order_by('id'))
+    _check_stock(skus, counts)
+
+    # update df_goods_sku set stock=stock-CASE..., sales=sales+CASE...
+    # where (id=1 and stock=原库存) or (id=3 and stock=原库存) ...
+    condition = Q()
+    for sku in skus:
+        condition |= Q(id=sku.id, stock=sku.stock)
+    case = sku_count_case(counts)
+    res = GoodsSKU.objects.filter(condition).update(stock=F('stock') - case, sales=F('sales') + case)
+    if res != len(skus):
+        # 有商品的库存被修改，部分更新需要由调用者回滚
+        raise StockConflict(skus)
+    enqueue_skus(counts)
+
+    _create_order_goods(order, skus, counts)
+
+
+def commit_order_reserved(order, counts):
+    '''已经在redis中预留了库存的订单：不锁定商品，只加入订单商品，库存和销量由后台任务批量写回，需要在事务中调用'''
+    skus = list(GoodsSKU.objects.filter(id__in=counts).order_by('id'))
+    if len(skus) != len(counts):
+        raise OrderCommitError(4, '商品不存在')
+
+    _create_order_goods(order, skus, counts)
@@ -0,0 +1,75 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.goods.models import Goods, GoodsSKU, GoodsType
+from apps.orders.commit import commit_order_locked, commit_order_optimistic
+from apps.orders.models import OrderGoods, OrderInfo
+from apps.users.models import Address, User
+
+
+def legacy_commit(order, counts):
+    '''原来逐条处理的下单方式：每个商品单独加锁、插入订单商品、保存商品'''
+    total_count = 0
+    total_price = 0
+    for sku_id, count in counts.items():
+        sku = GoodsSKU.objects.select_for_update().get(id=sku_id)
+        OrderGoods.objects.create(order=order, sku=sku, count=count, price=sku.price)
+        sku.stock -= count
+        sku.sales += count
+        sku.save()
+        total_count += count
+        total_price += sku.price*count
+    order.total_count = total_count
+    order.total_price = total_price
+    order.save()
+
+
+class Command(BaseCommand):
+    help = '对比逐条下单和批量下单的事务持有时间，测试数据在结束后全部回滚'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, default=30, help='每个订单的商品条数')
+        parser.add_argument('--rounds', type=int, default=50, help='每种方式的下单次数')
+
+    def handle(self, *args, **options):
+        lines = options['lines']
+        rounds = options['rounds']
+
+        with transaction.atomic():
+            # 准备测试数据
+            user = User.objects.create_user(username='bench_order_commit', password='bench')
+            addr = Address.objects.create(user=user, receiver='bench', addr='bench', phone='13800000000')
+            type = GoodsType.objects.create(name='bench', logo='bench', image='type/bench.jpg')
+            goods = Goods.objects.create(name='bench')
+            skus = [GoodsSKU.objects.create(type=type, goods=goods, name='bench%d' % i, desc='bench',
+                                            price=Decimal('9.90'), unite='500g', image='goods/bench.jpg',
+                                            stock=10**6) for i in range(lines)]
+            counts = {sku.id: 1 for sku in skus}
+
+            for name, commit in (('legacy', legacy_commit),
+                                 ('locked', commit_order_locked),
+                                 ('optimistic', commit_order_optimistic)):
+                timings = []
+                for i in range(rounds):
+                    save_id = transaction.savepoint()
+                    order = OrderInfo.objects.create(order_id='bench_%s_%d' % (name, i), user=user, addr=addr,
+                                                     pay_method=1, total_count=0, total_price=0,
+                                                     transit_price=10)
+                    # 从锁定第一个商品到订单写完的时间
+                    begin = time.perf_counter()
+                    commit(order, counts)
+                    timings.append(time.perf_counter() - begin)
+                    transaction.savepoint_rollback(save_id)
+
+                timings.sort()
+                self.stdout.write('%-10s lines=%d avg=%.2fms p50=%.2fms p95=%.2fms' % (
+                    name, lines,
+                    sum(timings) / len(timings) * 1000,
+                    timings[len(timings) // 2] * 1000,
+                    timings[int(len(timings) * 0.95)] * 1000))
+
+            # 回滚所有测试数据
+            transaction.set_rollback(True)
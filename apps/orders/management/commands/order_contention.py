@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+from apps.goods.models import GoodsSKU
+from apps.orders.optimistic import get_contention_stats
+
+
+class Command(BaseCommand):
+    help = '查看乐观锁下单时各商品的库存冲突次数、重试次数和热点状态'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20, help='显示冲突最多的商品数')
+
+    def handle(self, *args, **options):
+        stats = get_contention_stats(get_redis_connection('default'))[:options['top']]
+        names = dict(GoodsSKU.objects.filter(id__in=[stat['sku_id'] for stat in stats]).values_list('id', 'name'))
+        for stat in stats:
+            self.stdout.write('%8d  %-20s conflicts=%-8d retries=%-8d %s' % (
+                stat['sku_id'], names.get(stat['sku_id'], ''), stat['conflicts'], stat['retries'],
+                '悲观锁' if stat['hot'] else ''))
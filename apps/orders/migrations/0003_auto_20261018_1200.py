@@ -0,0 +1,21 @@
+# Generated by Django 2.0.6 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0002_auto_20181029_2124'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='orderinfo',
+            index=models.Index(fields=['user', 'create_time', 'order_id'], name='order_info_user_ctime_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ordergoods',
+            index=models.Index(fields=['sku', 'comment'], name='order_goods_sku_comment_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.0.6 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0003_auto_20261018_1200'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockSyncBatch',
+            fields=[
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now_add=True, verbose_name='更新时间')),
+                ('is_delete', models.BooleanField(default=False, verbose_name='删除标记')),
+                ('batch_id', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='批次id')),
+            ],
+            options={
+                'verbose_name': '库存写回批次',
+                'verbose_name_plural': '库存写回批次',
+                'db_table': 'df_stock_sync_batch',
+            },
+        ),
+    ]
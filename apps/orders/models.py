@@ -60,6 +60,10 @@ class OrderInfo(BaseModel):
 
     class Meta:
         db_table = 'df_order_info'
+        # 用户中心订单页按用户筛选，按创建时间排序
+        indexes = [
+            models.Index(fields=['user', 'create_time', 'order_id'], name='order_info_user_ctime_idx'),
+        ]
         verbose_name = '订单'
         verbose_name_plural = verbose_name
 
@@ -74,5 +78,19 @@ class OrderGoods(BaseModel):
 
     class Meta:
         db_table = 'df_order_goods'
+        # 详情页查询商品的评论
+        indexes = [
+            models.Index(fields=['sku', 'comment'], name='order_goods_sku_comment_idx'),
+        ]
         verbose_name = '订单商品'
         verbose_name_plural = verbose_name
+
+
+class StockSyncBatch(BaseModel):
+    '''已经写回mysql的库存批次，和库存更新在同一个事务中写入，同一批次不会重复写回'''
+    batch_id = models.CharField(max_length=64, primary_key=True, verbose_name='批次id')
+
+    class Meta:
+        db_table = 'df_stock_sync_batch'
+        verbose_name = '库存写回批次'
+        verbose_name_plural = verbose_name
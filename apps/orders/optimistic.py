@@ -0,0 +1,142 @@
+import random
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from apps.goods.models import GoodsSKU
+from apps.orders.commit import OrderCommitError, StockConflict, commit_order_locked, commit_order_optimistic
+
+# 商品累计的库存冲突次数 {商品id: 次数}
+SKU_CONFLICT_COUNT_KEY = 'sku_conflict_count'
+# 商品累计的重试次数 {商品id: 次数}
+SKU_RETRY_COUNT_KEY = 'sku_retry_count'
+# 商品在统计窗口内的冲突次数
+SKU_CONFLICT_WINDOW_KEY = 'sku_conflict_window_'
+# 冲突过多、改为悲观锁下单的商品 {商品id: 恢复乐观锁的时间}
+HOT_SKU_KEY = 'hot_skus'
+
+# 记录冲突的商品，窗口内冲突次数达到阈值的商品标记为热点商品
+# KEYS: 累计冲突次数, 热点商品
+# ARGV: 统计窗口(秒), 冲突阈值, 热点标记的过期时间, 商品id1, 商品id2 ...
+RECORD_CONFLICT_SCRIPT = '''
+for i = 4, #ARGV do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], 1)
+    local key = '%s' .. ARGV[i]
+    local n = redis.call('INCR', key)
+    if n == 1 then
+        redis.call('EXPIRE', key, ARGV[1])
+    end
+    if n >= tonumber(ARGV[2]) then
+        redis.call('ZADD', KEYS[2], ARGV[3], ARGV[i])
+    end
+end
+return 0
+''' % SKU_CONFLICT_WINDOW_KEY
+
+
+def get_hot_skus(conn):
+    '''获取当前的热点商品id'''
+    now = int(time.time())
+    pipe = conn.pipeline()
+    # 清除已经过期的热点标记
+    pipe.zremrangebyscore(HOT_SKU_KEY, 0, now)
+    pipe.zrange(HOT_SKU_KEY, 0, -1)
+    return {int(sku_id) for sku_id in pipe.execute()[1]}
+
+
+def record_conflicts(conn, sku_ids):
+    '''记录发生库存冲突的商品'''
+    if not sku_ids:
+        return
+    hot_until = int(time.time()) + settings.HOT_SKU_TTL
+    conn.register_script(RECORD_CONFLICT_SCRIPT)(
+        keys=[SKU_CONFLICT_COUNT_KEY, HOT_SKU_KEY],
+        args=[settings.HOT_SKU_WINDOW, settings.HOT_SKU_CONFLICT_THRESHOLD, hot_until] + list(sku_ids))
+
+
+def record_retries(conn, sku_ids, retries):
+    '''记录下单成功前的重试次数'''
+    pipe = conn.pipeline()
+    for sku_id in sku_ids:
+        pipe.hincrby(SKU_RETRY_COUNT_KEY, sku_id, retries)
+    pipe.execute()
+
+
+def get_contention_stats(conn):
+    '''获取各商品的冲突次数、重试次数和是否为热点商品，按冲突次数从多到少排序'''
+    pipe = conn.pipeline()
+    pipe.hgetall(SKU_CONFLICT_COUNT_KEY)
+    pipe.hgetall(SKU_RETRY_COUNT_KEY)
+    conflicts, retries = pipe.execute()
+    hot_skus = get_hot_skus(conn)
+
+    stats = []
+    for sku_id in set(conflicts) | set(retries):
+        stats.append({'sku_id': int(sku_id),
+                      'conflicts': int(conflicts.get(sku_id, 0)),
+                      'retries': int(retries.get(sku_id, 0)),
+                      'hot': int(sku_id) in hot_skus})
+    stats.sort(key=lambda stat: stat['conflicts'], reverse=True)
+    return stats
+
+
+def _changed_skus(skus):
+    # 事务回滚后重新查询库存，找出库存被其他订单修改的商品
+    stocks = dict(GoodsSKU.objects.filter(id__in=[sku.id for sku in skus]).values_list('id', 'stock'))
+    return [sku.id for sku in skus if stocks.get(sku.id) != sku.stock]
+
+
+def _backoff(attempt):
+    # 指数退避加随机抖动，避免冲突的订单同时重试
+    delay = min(settings.ORDER_OPTIMISTIC_BACKOFF_MAX, settings.ORDER_OPTIMISTIC_BACKOFF * 2 ** attempt)
+    return random.uniform(0, delay)
+
+
+def commit_order_with_retry(conn, create_order, counts):
+    '''乐观锁下单，库存冲突时退避后重试，返回订单，不能在事务中调用
+
+    create_order: 创建订单(OrderInfo)的函数，在每次尝试的事务中调用
+    每次尝试在单独的事务中进行，冲突时整个事务回滚，释放条件update和创建订单时加的行锁，在事务外退避，
+    不会在等待时锁住热点商品。
+    订单中有热点商品时直接使用悲观锁下单。
+    ORDER_OPTIMISTIC_RETRY_UNTIL_SHORTAGE为True时一直重试到库存确实不足，最长等待ORDER_OPTIMISTIC_MAX_WAIT秒，
+    否则最多重试ORDER_OPTIMISTIC_RETRIES次
+    开启ORDER_STOCK_RESERVATION时库存以redis中的计数器为准，不能使用
+    '''
+    if settings.ORDER_STOCK_RESERVATION:
+        raise RuntimeError('开启库存预留时不能直接修改mysql中的库存')
+
+    if get_hot_skus(conn) & set(counts):
+        with transaction.atomic():
+            order = create_order()
+            commit_order_locked(order, counts)
+        return order
+
+    until_shortage = settings.ORDER_OPTIMISTIC_RETRY_UNTIL_SHORTAGE
+    deadline = time.time() + settings.ORDER_OPTIMISTIC_MAX_WAIT
+    attempt = 0
+    while True:
+        try:
+            with transaction.atomic():
+                order = create_order()
+                # 库存确实不足时抛出OrderCommitError，不再重试
+                commit_order_optimistic(order, counts)
+        except StockConflict as e:
+            # 事务已经回滚
+            record_conflicts(conn, _changed_skus(e.skus))
+
+            if until_shortage:
+                exhausted = time.time() >= deadline
+            else:
+                exhausted = attempt >= settings.ORDER_OPTIMISTIC_RETRIES
+            if exhausted:
+                raise OrderCommitError(6, '下单失败2')
+
+            time.sleep(_backoff(attempt))
+            attempt += 1
+            continue
+
+        if attempt:
+            record_retries(conn, counts, attempt)
+        return order
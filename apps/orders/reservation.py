@@ -0,0 +1,265 @@
+import time
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from apps.goods.models import GoodsSKU
+from apps.goods.search_queue import enqueue_skus
+from apps.orders.commit import OrderCommitError, sku_count_case
+from apps.orders.models import StockSyncBatch
+
+# 商品在redis中的库存计数器
+STOCK_KEY = 'stock_%d'
+# 预留单 {商品id: 数量}
+RESERVATION_KEY = 'reservation_%s'
+# 所有未认领的预留单及其过期时间，订单事务中认领后移出
+RESERVATION_EXPIRE_KEY = 'reservation_expire'
+# 已确认但还没有写回mysql的销售数量 {商品id: 数量}
+STOCK_PENDING_KEY = 'stock_pending'
+# 正在写回mysql的销售数量
+STOCK_SYNCING_KEY = 'stock_syncing'
+# 正在写回的这一轮的id，每批写回的批次id由它和批次中第一个商品id组成
+STOCK_SYNCING_ID_KEY = 'stock_syncing_id'
+# 已预留但还没有确认或释放的数量 {商品id: 数量}，计数器重新加载时需要减去
+STOCK_RESERVED_KEY = 'stock_reserved'
+
+# 一次预留多个商品的库存，全部足够才扣减
+# KEYS: 预留单, 预留单过期集合, 已预留数量, 各商品库存计数器
+# ARGV: 预留单id, 过期时间, 商品id1, 数量1, 商品id2, 数量2 ...
+# 返回 {0, 0} 成功，{-1, i} 第i个商品的计数器不存在，{-2, i} 第i个商品库存不足
+RESERVE_SCRIPT = '''
+local n = #KEYS - 3
+for i = 1, n do
+    local stock = redis.call('GET', KEYS[3 + i])
+    if not stock then
+        return {-1, i}
+    end
+    if tonumber(stock) < tonumber(ARGV[2 + 2 * i]) then
+        return {-2, i}
+    end
+end
+for i = 1, n do
+    redis.call('DECRBY', KEYS[3 + i], ARGV[2 + 2 * i])
+    redis.call('HSET', KEYS[1], ARGV[1 + 2 * i], ARGV[2 + 2 * i])
+    redis.call('HINCRBY', KEYS[3], ARGV[1 + 2 * i], ARGV[2 + 2 * i])
+end
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+return {0, 0}
+'''
+
+# 计数器不存在时用mysql中的库存初始化，需要减去还没有写回mysql的销售数量和还没有确认的预留数量
+# KEYS: 库存计数器, 待写回销售数量, 正在写回的销售数量, 已预留数量
+# ARGV: 商品id, mysql中的库存
+LOAD_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local pending = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')
+local syncing = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0')
+local reserved = tonumber(redis.call('HGET', KEYS[4], ARGV[1]) or '0')
+redis.call('SET', KEYS[1], tonumber(ARGV[2]) - pending - syncing - reserved)
+return 1
+'''
+
+# 减少商品的已预留数量，为0时删除
+UNRESERVE = '''
+local function unreserve(key, sku_id, count)
+    if redis.call('HINCRBY', key, sku_id, -tonumber(count)) <= 0 then
+        redis.call('HDEL', key, sku_id)
+    end
+end
+'''
+
+# 库存计数器加上后台修改的库存变化量，计数器不存在时不做任何操作(下次预留时从mysql加载)
+# KEYS: 库存计数器
+# ARGV: 变化量
+ADJUST_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('INCRBY', KEYS[1], ARGV[1])
+return 1
+'''
+
+# 取消预留，库存还回计数器。预留单已确认或已释放时不做任何操作
+# 过期释放时只释放还在过期集合中(没有被下单认领)的预留单
+# 计数器不存在时不还回，下次加载时不再减去这部分预留，否则会创建一个只有预留数量的计数器
+# KEYS: 预留单, 预留单过期集合, 已预留数量
+# ARGV: 预留单id, 库存计数器key前缀, 是否为过期释放(1/0)
+RELEASE_SCRIPT = UNRESERVE + '''
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 0 and ARGV[3] == '1' then
+    return 0
+end
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local items = redis.call('HGETALL', KEYS[1])
+for i = 1, #items, 2 do
+    unreserve(KEYS[3], items[i], items[i + 1])
+    if redis.call('EXISTS', ARGV[2] .. items[i]) == 1 then
+        redis.call('INCRBY', ARGV[2] .. items[i], items[i + 1])
+    end
+end
+redis.call('DEL', KEYS[1])
+return 1
+'''
+
+# 确认已认领的预留单，销售数量记入待写回mysql的数量。预留单已确认或已释放时返回0
+# KEYS: 预留单, 待写回销售数量, 已预留数量
+CONFIRM_SCRIPT = UNRESERVE + '''
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local items = redis.call('HGETALL', KEYS[1])
+for i = 1, #items, 2 do
+    unreserve(KEYS[3], items[i], items[i + 1])
+    redis.call('HINCRBY', KEYS[2], items[i], items[i + 1])
+end
+redis.call('DEL', KEYS[1])
+return 1
+'''
+
+# 取出待写回的销售数量，上次写回失败时继续处理上次的数据
+# KEYS: 待写回销售数量, 正在写回的销售数量, 这一轮的id
+# ARGV: 开始新的一轮时使用的id
+# 返回 {这一轮的id, 是否为新的一轮, {商品id1, 数量1, ...}}
+TAKE_PENDING_SCRIPT = '''
+local new = 0
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return {'', 0, {}}
+    end
+    redis.call('RENAME', KEYS[1], KEYS[2])
+    redis.call('SET', KEYS[3], ARGV[1])
+    new = 1
+end
+local sync_id = redis.call('GET', KEYS[3])
+if not sync_id then
+    sync_id = ARGV[1]
+    redis.call('SET', KEYS[3], sync_id)
+end
+return {sync_id, new, redis.call('HGETALL', KEYS[2])}
+'''
+
+
+def load_stock(conn, sku_id):
+    '''用mysql中的库存初始化商品的库存计数器，商品不存在时返回False'''
+    # 锁定商品，避免读取库存后、初始化计数器前写回任务修改了库存
+    with transaction.atomic():
+        try:
+            stock = GoodsSKU.objects.select_for_update().values_list('stock', flat=True).get(id=sku_id)
+        except GoodsSKU.DoesNotExist:
+            return False
+        conn.register_script(LOAD_SCRIPT)(
+            keys=[STOCK_KEY % sku_id, STOCK_PENDING_KEY, STOCK_SYNCING_KEY, STOCK_RESERVED_KEY], args=[sku_id, stock])
+    return True
+
+
+def reset_stock(conn, sku_id):
+    '''删除计数器，下次预留时重新从mysql加载'''
+    conn.delete(STOCK_KEY % sku_id)
+
+
+def adjust_stock(conn, sku_id, delta):
+    '''后台修改了商品库存后调用，计数器加上库存的变化量，已经扣减的预留和待写回的销售数量不受影响
+
+    需要在锁定商品的事务中调用，避免计数器不存在时并发的加载读到修改前的库存
+    '''
+    if delta:
+        conn.register_script(ADJUST_SCRIPT)(keys=[STOCK_KEY % sku_id], args=[delta])
+
+
+def reserve_stock(conn, counts):
+    '''原子地预留订单所有商品的库存，返回预留单id
+
+    counts: {商品id: 数量}
+    商品不存在或库存不足时抛出OrderCommitError，此时不会访问mysql的订单表
+    '''
+    reservation_id = uuid.uuid4().hex
+    sku_ids = sorted(counts)
+    keys = [RESERVATION_KEY % reservation_id, RESERVATION_EXPIRE_KEY, STOCK_RESERVED_KEY]
+    keys += [STOCK_KEY % sku_id for sku_id in sku_ids]
+    args = [reservation_id, int(time.time()) + settings.STOCK_RESERVATION_TTL]
+    for sku_id in sku_ids:
+        args += [sku_id, counts[sku_id]]
+
+    reserve = conn.register_script(RESERVE_SCRIPT)
+    # 每次最多初始化一个计数器，最多尝试商品数+1次
+    for i in range(len(sku_ids) + 1):
+        res, index = reserve(keys=keys, args=args)
+        if res == 0:
+            return reservation_id
+        if res == -2:
+            raise OrderCommitError(5, '商品库存不足')
+        # 计数器不存在，从mysql加载后重试
+        if not load_stock(conn, sku_ids[index - 1]):
+            raise OrderCommitError(4, '商品不存在')
+    raise OrderCommitError(6, '下单失败')
+
+
+def claim_reservation(conn, reservation_id):
+    '''在订单事务中认领预留单，认领后不会被过期释放，预留单已经过期释放时抛出OrderCommitError'''
+    if not conn.zrem(RESERVATION_EXPIRE_KEY, reservation_id):
+        raise OrderCommitError(6, '下单超时')
+
+
+def confirm_reservation(conn, reservation_id):
+    '''订单事务提交后确认预留，销售数量记入待写回mysql的数量
+
+    在提交前确认的话，提交失败时销售数量已经不能撤回，会写回mysql
+    '''
+    return conn.register_script(CONFIRM_SCRIPT)(
+        keys=[RESERVATION_KEY % reservation_id, STOCK_PENDING_KEY, STOCK_RESERVED_KEY])
+
+
+def release_reservation(conn, reservation_id, expired=False):
+    '''取消预留(包括已认领、订单事务失败的预留单)，库存还回计数器
+
+    expired为True时是过期释放，不释放已经被认领的预留单
+    '''
+    return conn.register_script(RELEASE_SCRIPT)(
+        keys=[RESERVATION_KEY % reservation_id, RESERVATION_EXPIRE_KEY, STOCK_RESERVED_KEY],
+        args=[reservation_id, STOCK_KEY.replace('%d', ''), 1 if expired else 0])
+
+
+def release_expired_reservations(conn):
+    '''释放所有已经过期的预留单，返回释放的数量'''
+    released = 0
+    for reservation_id in conn.zrangebyscore(RESERVATION_EXPIRE_KEY, 0, int(time.time())):
+        released += release_reservation(conn, reservation_id.decode(), expired=True)
+    return released
+
+
+def sync_stock_to_db(conn):
+    '''把已确认的销售数量分批写回mysql的库存和销量，返回写回的商品数
+
+    每批写回时在同一个事务中记录批次id，写回后、从redis删除前进程退出的话，下次不会重复写回
+    '''
+    sync_id, new, items = conn.register_script(TAKE_PENDING_SCRIPT)(
+        keys=[STOCK_PENDING_KEY, STOCK_SYNCING_KEY, STOCK_SYNCING_ID_KEY], args=[uuid.uuid4().hex])
+    counts = {int(items[i]): int(items[i + 1]) for i in range(0, len(items), 2)}
+    sync_id = sync_id.decode() if isinstance(sync_id, bytes) else sync_id
+    if new:
+        # 上一轮已经全部写回，它的批次记录不再需要
+        StockSyncBatch.objects.exclude(batch_id__startswith=sync_id).delete()
+
+    sku_ids = sorted(counts)
+    batch_size = settings.STOCK_SYNC_BATCH_SIZE
+    for i in range(0, len(sku_ids), batch_size):
+        batch = {sku_id: counts[sku_id] for sku_id in sku_ids[i:i + batch_size]}
+        # update df_goods_sku set stock=stock-CASE..., sales=sales+CASE... where id in (...)
+        case = sku_count_case(batch)
+        # 剩余的商品相同时分批相同，批次id也相同
+        batch_id = '%s_%d' % (sync_id, sku_ids[i])
+        with transaction.atomic():
+            batch_record, created = StockSyncBatch.objects.get_or_create(batch_id=batch_id)
+            if created:
+                GoodsSKU.objects.filter(id__in=batch).update(stock=F('stock') - case, sales=F('sales') + case)
+                # 销量和是否有货在搜索索引中
+                enqueue_skus(batch)
+        # 每批写回后立即删除，写回中途失败时下次只处理剩余的商品
+        conn.hdel(STOCK_SYNCING_KEY, *batch)
+
+    return len(sku_ids)
@@ -0,0 +1,85 @@
+import json
+
+from django.conf import settings
+from django.db import transaction
+
+from apps.cart.store import get_cart_store
+from apps.orders.commit import commit_order_locked, commit_order_reserved, get_order_counts
+from apps.orders.models import OrderInfo
+from apps.orders.reservation import claim_reservation, confirm_reservation, release_reservation, reserve_stock
+from utils.snowflake import next_id
+
+# 异步下单的处理结果
+ORDER_STATUS_KEY = 'order_status_%s'
+
+
+def create_order(conn, user, addr, pay_method, sku_ids):
+    '''创建订单，成功后清除购物车中对应的记录，返回订单
+
+    失败时抛出OrderCommitError，已经写入的数据全部回滚。不能在事务中调用，订单提交后才确认库存预留
+    '''
+    # 订单id：雪花算法生成，全局唯一且随时间递增
+    order_id = str(next_id())
+
+    # 运费
+    transit_price = 10
+
+    cart_store = get_cart_store()
+
+    # 一次从购物车中获取用户所要购买的所有商品的数量 {商品id: 数量}
+    counts = get_order_counts(cart_store, user.id, sku_ids)
+
+    reservation_id = None
+    if settings.ORDER_STOCK_RESERVATION:
+        # 先在redis中原子地预留所有商品的库存，库存不足的订单不会访问mysql
+        reservation_id = reserve_stock(conn, counts)
+
+    try:
+        with transaction.atomic():
+            # 向df_order_info表中添加一条记录，总数量和总价格在加入订单商品后更新
+            order = OrderInfo.objects.create(order_id=order_id,
+                                             user=user,
+                                             addr=addr,
+                                             pay_method=pay_method,
+                                             total_count=0,
+                                             total_price=0,
+                                             transit_price=transit_price)
+            if reservation_id:
+                # 库存已经预留，只加入订单商品，库存和销量由后台任务批量写回
+                commit_order_reserved(order, counts)
+                # 认领预留，不再被过期释放，预留已经过期时下单失败
+                claim_reservation(conn, reservation_id)
+            else:
+                # 按id顺序锁定所有商品，一条语句更新库存和销量，一条语句加入所有订单商品
+                commit_order_locked(order, counts)
+    except Exception:
+        if reservation_id:
+            # 取消预留，库存还回redis
+            release_reservation(conn, reservation_id)
+        raise
+
+    if reservation_id:
+        # 订单已经提交，确认预留，销售数量由后台任务写回mysql
+        confirm_reservation(conn, reservation_id)
+
+    # 清除用户购物车中对应的记录
+    cart_store.clear_many(user.id, sku_ids)
+
+    return order
+
+
+def set_order_status(conn, ticket, user_id, status):
+    '''保存异步下单的处理状态'''
+    status['user_id'] = user_id
+    conn.set(ORDER_STATUS_KEY % ticket, json.dumps(status), ex=settings.ORDER_STATUS_TTL)
+
+
+def get_order_status(conn, ticket, user_id):
+    '''获取异步下单的处理状态，不存在或不属于该用户时返回None'''
+    status = conn.get(ORDER_STATUS_KEY % ticket)
+    if status is None:
+        return None
+    status = json.loads(status)
+    if status.pop('user_id') != user_id:
+        return None
+    return status
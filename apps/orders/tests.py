@@ -1,3 +1,378 @@
-from django.test import TestCase
+import os
+import threading
+import unittest
+import uuid
+from decimal import Decimal
+from unittest import mock
+
+import redis
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from apps.goods.models import Goods, GoodsSKU, GoodsType
+from apps.orders import commit, optimistic
+from apps.orders.commit import (OrderCommitError, StockConflict, commit_order_locked, commit_order_optimistic,
+                                sku_count_case)
+from apps.orders.models import OrderGoods, OrderInfo
+from apps.orders.optimistic import commit_order_with_retry
+from apps.orders.reservation import (STOCK_KEY, STOCK_PENDING_KEY, STOCK_RESERVED_KEY, STOCK_SYNCING_KEY,
+                                     adjust_stock, claim_reservation, confirm_reservation,
+                                     release_expired_reservations, release_reservation, reserve_stock, reset_stock,
+                                     sync_stock_to_db)
+from apps.users.models import Address, User
+from utils import snowflake
+from utils.snowflake import Snowflake
+
+
+class SnowflakeTest(SimpleTestCase):
+    '''订单id生成器测试'''
+    def test_unique_across_threads(self):
+        generator = Snowflake(1)
+        results = [[] for i in range(8)]
+
+        def generate(ids):
+            for i in range(20000):
+                ids.append(generator.next_id())
+
+        threads = [threading.Thread(target=generate, args=(ids,)) for ids in results]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        all_ids = [id for ids in results for id in ids]
+        self.assertEqual(len(set(all_ids)), 8 * 20000)
+        # 每个线程拿到的id都是递增的
+        for ids in results:
+            self.assertEqual(ids, sorted(ids))
+
+    def test_worker_id_in_id(self):
+        id1 = Snowflake(1).next_id()
+        id2 = Snowflake(2).next_id()
+        self.assertNotEqual(id1, id2)
+        self.assertEqual((id2 >> snowflake.SEQUENCE_BITS) & snowflake.MAX_WORKER_ID, 2)
+
+    def test_sequence_overflow_waits_next_millisecond(self):
+        generator = Snowflake(1)
+        now = snowflake.EPOCH + 1000
+        with mock.patch.object(generator, '_now', side_effect=[now] * (snowflake.MAX_SEQUENCE + 2) + [now + 1]):
+            ids = [generator.next_id() for i in range(snowflake.MAX_SEQUENCE + 2)]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertTrue(all(id > 0 for id in ids))
+        self.assertEqual(generator.last_timestamp, now + 1)
+
+    def test_clock_moved_backwards(self):
+        generator = Snowflake(1)
+        now = snowflake.EPOCH + 5000
+        with mock.patch.object(generator, '_now', side_effect=[now, now - 10]):
+            first = generator.next_id()
+            second = generator.next_id()
+        self.assertGreater(second, first)
+        self.assertGreater(first, 0)
+        with mock.patch.object(generator, '_now', return_value=now - 4000):
+            self.assertRaises(RuntimeError, generator.next_id)
+
+    def test_invalid_worker_id(self):
+        self.assertRaises(ValueError, Snowflake, snowflake.MAX_WORKER_ID + 1)
+
+
+# 库存预留测试使用单独的redis库，每个测试前清空: TEST_REDIS_URL=redis://127.0.0.1:6379/15
+test_redis = redis.StrictRedis.from_url(os.environ.get('TEST_REDIS_URL', 'redis://127.0.0.1:6379/15'))
+
+
+def redis_available():
+    try:
+        return test_redis.ping()
+    except redis.ConnectionError:
+        return False
+
+
+@unittest.skipUnless(redis_available(), '库存预留测试需要redis: TEST_REDIS_URL')
+class ReservationTest(TestCase):
+    '''redis库存预留测试'''
+    @classmethod
+    def setUpTestData(cls):
+        goods = Goods.objects.create(name='草莓')
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type/fruit.jpg')
+        cls.sku = GoodsSKU.objects.create(type=type, goods=goods, name='草莓', desc='简介', price='10.00',
+                                          stock=10, unite='500g', image='goods/0.jpg')
+
+    def setUp(self):
+        self.conn = test_redis
+        self.conn.flushdb()
+
+    def stock(self):
+        return int(self.conn.get(STOCK_KEY % self.sku.id))
+
+    def pending(self):
+        return {int(k): int(v) for k, v in self.conn.hgetall(STOCK_PENDING_KEY).items()}
+
+    def test_reserve_claim_confirm(self):
+        reservation_id = reserve_stock(self.conn, {self.sku.id: 3})
+        # 计数器从mysql加载后扣减
+        self.assertEqual(self.stock(), 7)
+        claim_reservation(self.conn, reservation_id)
+        # 认领后不会被过期释放
+        with override_settings(STOCK_RESERVATION_TTL=-1):
+            self.assertEqual(release_expired_reservations(self.conn), 0)
+        self.assertEqual(self.pending(), {})
+        self.assertEqual(confirm_reservation(self.conn, reservation_id), 1)
+        self.assertEqual(self.pending(), {self.sku.id: 3})
+        # 重复确认不会重复记录
+        self.assertEqual(confirm_reservation(self.conn, reservation_id), 0)
+        self.assertEqual(release_reservation(self.conn, reservation_id), 0)
+        self.assertEqual(self.stock(), 7)
+
+    def test_shortage(self):
+        reserve_stock(self.conn, {self.sku.id: 8})
+        with self.assertRaises(OrderCommitError) as cm:
+            reserve_stock(self.conn, {self.sku.id: 3})
+        self.assertEqual(cm.exception.res, 5)
+        self.assertEqual(self.stock(), 2)
+
+    def test_release_after_failed_commit(self):
+        # 订单事务在认领后失败，库存还回计数器，不记入待写回的数量
+        reservation_id = reserve_stock(self.conn, {self.sku.id: 3})
+        claim_reservation(self.conn, reservation_id)
+        self.assertEqual(release_reservation(self.conn, reservation_id), 1)
+        self.assertEqual(self.stock(), 10)
+        self.assertEqual(confirm_reservation(self.conn, reservation_id), 0)
+        self.assertEqual(self.pending(), {})
+
+    @override_settings(STOCK_RESERVATION_TTL=-1)
+    def test_expired_reservation(self):
+        reservation_id = reserve_stock(self.conn, {self.sku.id: 3})
+        self.assertEqual(release_expired_reservations(self.conn), 1)
+        self.assertEqual(self.stock(), 10)
+        # 过期后不能再下单
+        self.assertRaises(OrderCommitError, claim_reservation, self.conn, reservation_id)
+
+    def test_release_after_reset(self):
+        reservation_id = reserve_stock(self.conn, {self.sku.id: 3})
+        reset_stock(self.conn, self.sku.id)
+        # 计数器不存在时不还回，不会创建只有预留数量的计数器
+        self.assertEqual(release_reservation(self.conn, reservation_id), 1)
+        self.assertFalse(self.conn.exists(STOCK_KEY % self.sku.id))
+        self.assertFalse(self.conn.exists(STOCK_RESERVED_KEY))
+        reserve_stock(self.conn, {self.sku.id: 1})
+        self.assertEqual(self.stock(), 9)
+
+    def test_confirm_after_reset(self):
+        reservation_id = reserve_stock(self.conn, {self.sku.id: 3})
+        reset_stock(self.conn, self.sku.id)
+        # 重新加载时减去还没有确认的预留
+        reserve_stock(self.conn, {self.sku.id: 1})
+        self.assertEqual(self.stock(), 6)
+        claim_reservation(self.conn, reservation_id)
+        confirm_reservation(self.conn, reservation_id)
+        reset_stock(self.conn, self.sku.id)
+        reserve_stock(self.conn, {self.sku.id: 1})
+        # 10 - 待写回3 - 预留1 - 1
+        self.assertEqual(self.stock(), 5)
+
+    def test_adjust_stock(self):
+        reservation_id = reserve_stock(self.conn, {self.sku.id: 3})
+        # 后台把库存从10改为15
+        adjust_stock(self.conn, self.sku.id, 5)
+        self.assertEqual(self.stock(), 12)
+        release_reservation(self.conn, reservation_id)
+        self.assertEqual(self.stock(), 15)
+        # 计数器不存在时不创建
+        reset_stock(self.conn, self.sku.id)
+        adjust_stock(self.conn, self.sku.id, 5)
+        self.assertFalse(self.conn.exists(STOCK_KEY % self.sku.id))
+
+    def test_reload_and_sync(self):
+        reservation_id = reserve_stock(self.conn, {self.sku.id: 3})
+        claim_reservation(self.conn, reservation_id)
+        confirm_reservation(self.conn, reservation_id)
+        # 计数器重新加载时减去还没有写回mysql的数量
+        reset_stock(self.conn, self.sku.id)
+        reserve_stock(self.conn, {self.sku.id: 1})
+        self.assertEqual(self.stock(), 6)
+
+        self.assertEqual(sync_stock_to_db(self.conn), 1)
+        self.sku.refresh_from_db()
+        self.assertEqual((self.sku.stock, self.sku.sales), (7, 3))
+        self.assertEqual(self.pending(), {})
+        self.assertFalse(self.conn.exists(STOCK_SYNCING_KEY))
+
+    def test_sync_is_idempotent(self):
+        reservation_id = reserve_stock(self.conn, {self.sku.id: 3})
+        claim_reservation(self.conn, reservation_id)
+        confirm_reservation(self.conn, reservation_id)
+        # 写回mysql后、从redis删除前进程退出
+        with mock.patch.object(self.conn, 'hdel', side_effect=redis.ConnectionError):
+            self.assertRaises(redis.ConnectionError, sync_stock_to_db, self.conn)
+        self.assertEqual(sync_stock_to_db(self.conn), 1)
+        self.sku.refresh_from_db()
+        self.assertEqual((self.sku.stock, self.sku.sales), (7, 3))
+        self.assertFalse(self.conn.exists(STOCK_SYNCING_KEY))
+
+
+@unittest.skipUnless(redis_available(), '机器id租约测试需要redis: TEST_REDIS_URL')
+class WorkerLeaseTest(SimpleTestCase):
+    '''订单id生成器的机器id租约测试'''
+    def setUp(self):
+        self.conn = test_redis
+        self.conn.flushdb()
+
+    def test_leases_are_unique(self):
+        worker_ids = {snowflake.acquire_worker_id(self.conn, 'token%d' % i, 60) for i in range(5)}
+        self.assertEqual(len(worker_ids), 5)
+
+    def test_renew_only_own_lease(self):
+        worker_id = snowflake.acquire_worker_id(self.conn, 'a', 60)
+        self.assertTrue(snowflake.renew_worker_id(self.conn, worker_id, 'a', 60))
+        # 租约过期后被其他进程获取
+        self.conn.set(snowflake.WORKER_LEASE_KEY % worker_id, 'b')
+        self.assertFalse(snowflake.renew_worker_id(self.conn, worker_id, 'a', 60))
+
+    def test_all_worker_ids_taken(self):
+        pipe = self.conn.pipeline()
+        for worker_id in range(snowflake.MAX_WORKER_ID + 1):
+            pipe.set(snowflake.WORKER_LEASE_KEY % worker_id, 'other', ex=60)
+        pipe.execute()
+        self.assertRaises(RuntimeError, snowflake.acquire_worker_id, self.conn, 'a', 60)
+
+
+class OrderDataMixin(object):
+    '''创建下单测试用的用户、地址和商品'''
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = User.objects.create_user('buyer', 'buyer@example.com', 'password')
+        cls.addr = Address.objects.create(user=cls.user, receiver='张三', addr='北京', phone='13800000000')
+        goods = Goods.objects.create(name='草莓')
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type/fruit.jpg')
+        cls.skus = [GoodsSKU.objects.create(type=type, goods=goods, name='商品%d' % i, desc='简介',
+                                            price='%d.50' % (i + 1), stock=10, unite='500g',
+                                            image='goods/%d.jpg' % i) for i in range(2)]
+
+    def create_order_info(self):
+        return OrderInfo.objects.create(order_id=uuid.uuid4().hex, user=self.user, addr=self.addr, pay_method=3,
+                                        total_count=0, total_price=0, transit_price=10)
+
+    def assertStock(self, *stocks):
+        self.assertEqual([(sku.stock, sku.sales) for sku in GoodsSKU.objects.order_by('id')], list(stocks))
+
+
+class CommitOrderTest(OrderDataMixin, TestCase):
+    '''悲观锁和乐观锁下单测试'''
+    def setUp(self):
+        self.counts = {self.skus[0].id: 2, self.skus[1].id: 1}
+
+    def assertOrder(self, order):
+        order.refresh_from_db()
+        self.assertEqual((order.total_count, order.total_price), (3, Decimal('5.50')))
+        self.assertEqual(list(OrderGoods.objects.filter(order=order).order_by('sku_id').values_list(
+            'sku_id', 'count', 'price')), [(self.skus[0].id, 2, Decimal('1.50')), (self.skus[1].id, 1, Decimal('2.50'))])
+
+    def test_sku_count_case(self):
+        counts = dict(GoodsSKU.objects.annotate(count=sku_count_case({self.skus[0].id: 2})).values_list('id', 'count'))
+        # 不在订单中的商品为0
+        self.assertEqual(counts, {self.skus[0].id: 2, self.skus[1].id: 0})
+
+    def test_locked(self):
+        order = self.create_order_info()
+        commit_order_locked(order, self.counts)
+        self.assertStock((8, 2), (9, 1))
+        self.assertOrder(order)
+
+    def test_optimistic(self):
+        order = self.create_order_info()
+        commit_order_optimistic(order, self.counts)
+        self.assertStock((8, 2), (9, 1))
+        self.assertOrder(order)
+
+    def test_sku_not_exist(self):
+        for commit_order in (commit_order_locked, commit_order_optimistic):
+            with self.assertRaises(OrderCommitError) as cm:
+                commit_order(self.create_order_info(), {self.skus[0].id: 1, 0: 1})
+            self.assertEqual(cm.exception.res, 4)
+        self.assertStock((10, 0), (10, 0))
+
+    def test_shortage(self):
+        for commit_order in (commit_order_locked, commit_order_optimistic):
+            with self.assertRaises(OrderCommitError) as cm:
+                commit_order(self.create_order_info(), {self.skus[0].id: 1, self.skus[1].id: 11})
+            self.assertEqual(cm.exception.res, 5)
+        self.assertStock((10, 0), (10, 0))
+        self.assertFalse(OrderGoods.objects.exists())
+
+    def test_optimistic_conflict(self):
+        check_stock = commit._check_stock
+
+        def concurrent_order(skus, counts):
+            check_stock(skus, counts)
+            # 读取商品后，其他订单修改了第二个商品的库存
+            GoodsSKU.objects.filter(id=self.skus[1].id).update(stock=9, sales=1)
+
+        with mock.patch('apps.orders.commit._check_stock', side_effect=concurrent_order):
+            with self.assertRaises(StockConflict) as cm:
+                with transaction.atomic():
+                    commit_order_optimistic(self.create_order_info(), self.counts)
+        self.assertEqual([sku.id for sku in cm.exception.skus], [sku.id for sku in self.skus])
+        # 第一个商品的部分更新和订单随事务回滚
+        self.assertStock((10, 0), (9, 1))
+        self.assertFalse(OrderInfo.objects.exists())
+        self.assertFalse(OrderGoods.objects.exists())
+
+
+@override_settings(ORDER_STOCK_RESERVATION=False, ORDER_OPTIMISTIC_RETRIES=2)
+class CommitOrderWithRetryTest(OrderDataMixin, TestCase):
+    '''乐观锁下单重试测试'''
+    def setUp(self):
+        self.conn = mock.Mock()
+        for name in ('get_hot_skus', 'record_conflicts', 'record_retries', 'time.sleep'):
+            patcher = mock.patch('apps.orders.optimistic.' + name)
+            setattr(self, name.replace('time.', ''), patcher.start())
+            self.addCleanup(patcher.stop)
+        self.get_hot_skus.return_value = set()
+        self.counts = {self.skus[0].id: 2, self.skus[1].id: 1}
+
+    def test_retry_after_conflict(self):
+        commit = optimistic.commit_order_optimistic
+        calls = []
+
+        def conflict_once(order, counts):
+            calls.append(order.order_id)
+            if len(calls) == 1:
+                # 第一次尝试时商品的库存被其他订单修改
+                sku = GoodsSKU.objects.get(id=self.skus[0].id)
+                sku.stock += 1
+                raise StockConflict([sku])
+            commit(order, counts)
+
+        with mock.patch('apps.orders.optimistic.commit_order_optimistic', side_effect=conflict_once):
+            order = commit_order_with_retry(self.conn, self.create_order_info, self.counts)
+
+        self.assertEqual(len(calls), 2)
+        # 第一次尝试的订单已经回滚
+        self.assertEqual(list(OrderInfo.objects.values_list('order_id', flat=True)), [order.order_id])
+        self.assertStock((8, 2), (9, 1))
+        self.record_conflicts.assert_called_once_with(self.conn, [self.skus[0].id])
+        self.record_retries.assert_called_once_with(self.conn, self.counts, 1)
+        self.assertEqual(self.sleep.call_count, 1)
+
+    def test_retries_exhausted(self):
+        with mock.patch('apps.orders.optimistic.commit_order_optimistic', side_effect=StockConflict([])):
+            with self.assertRaises(OrderCommitError) as cm:
+                commit_order_with_retry(self.conn, self.create_order_info, self.counts)
+        self.assertEqual(cm.exception.res, 6)
+        self.assertEqual(self.sleep.call_count, 2)
+        self.assertFalse(OrderInfo.objects.exists())
+        self.assertStock((10, 0), (10, 0))
+
+    def test_hot_sku_uses_locked(self):
+        self.get_hot_skus.return_value = {self.skus[1].id}
+        with mock.patch('apps.orders.optimistic.commit_order_optimistic') as optimistic:
+            order = commit_order_with_retry(self.conn, self.create_order_info, self.counts)
+        optimistic.assert_not_called()
+        self.assertEqual(order.total_count, 3)
+        self.assertStock((8, 2), (9, 1))
+
+    @override_settings(ORDER_STOCK_RESERVATION=True)
+    def test_refused_with_reservation(self):
+        self.assertRaises(RuntimeError, commit_order_with_retry, self.conn, self.create_order_info, self.counts)
 
-# Create your tests here.
@@ -6,4 +6,5 @@ app_name = 'order'
 urlpatterns = [
     path('place/', OrderPlaceView.as_view(), name='place'),
     path('commit/', OrderCommitView.as_view(), name='commit'),
+    path('status/<ticket>', OrderStatusView.as_view(), name='status'),  # 异步下单的处理结果
 ]
@@ -1,15 +1,23 @@
-from django.db import transaction
+import uuid
+from decimal import Decimal
+
+from django.conf import settings
 from django.http import JsonResponse
 from django.shortcuts import render, redirect
 from django.urls import reverse
 from django.views import View
 from django_redis import get_redis_connection
 
-from apps.goods.models import GoodsSKU
-from apps.orders.models import OrderInfo, OrderGoods
+from apps.cart.store import get_cart_store
+from apps.goods.sku_cache import get_many_skus
+from apps.orders.commit import OrderCommitError, get_order_counts
+from apps.orders.models import OrderInfo
+from apps.orders.optimistic import commit_order_with_retry
+from apps.orders.service import create_order, get_order_status, set_order_status
 from apps.users.models import Address
+from celery_tasks.tasks import commit_order, schedule_reservation_release, schedule_stock_sync
 from utils.mixin import LoginRequiresMixin
-from datetime import datetime
+from utils.snowflake import next_id
 
 
 class OrderPlaceView(LoginRequiresMixin, View):
@@ -21,24 +29,27 @@ class OrderPlaceView(LoginRequiresMixin, View):
         sku_ids = request.POST.getlist('sku_ids')
 
         # 检验参数
-        if not sku_ids:
+        if not sku_ids or not all(sku_id.isdigit() for sku_id in sku_ids):
             return redirect(reverse('cart:cart'))
 
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
+        # 一次获取所有商品的信息 {id: sku}
+        sku_dict = get_many_skus(sku_ids)
+        # 一次获取用户所要购买的所有商品的数量 {id: 数量}
+        counts = get_cart_store().items(user.id, sku_ids)
 
         skus = []
         # 保存商品的总件数和总价格
         total_count = 0
-        total_price = 0
+        total_price = Decimal('0')
         # 遍历sku_ids获取用户要购买的商品的信息
         for sku_id in sku_ids:
-            # 根据商品的id获取商品的信息
-            sku = GoodsSKU.objects.get(id=sku_id)
-            # 获取用户所要购买的商品的数量
-            count = conn.hget(cart_key, sku_id)
+            sku = sku_dict.get(int(sku_id))
+            count = counts.get(int(sku_id))
+            if sku is None or count is None:
+                # 商品不存在或者已经不在购物车中
+                continue
             # 计算商品的小计
-            amount = sku.price*int(count)
+            amount = sku.price*count
             # 动态给sku增加属性count，保存购买商品的数量
             sku.count = count
             # 动态给sku增加属性amount，保存购买商品的小计
@@ -46,11 +57,15 @@ class OrderPlaceView(LoginRequiresMixin, View):
             # 追加
             skus.append(sku)
             # 累加，计算商品的总件数和总价格
-            total_count += int(count)
+            total_count += count
             total_price += amount
 
+        if not skus:
+            # 没有可以购买的商品
+            return redirect(reverse('cart:cart'))
+
         # 运费：实际开发的时候，属于一个子系统
-        transit_price = 10  # 写死
+        transit_price = Decimal('10')  # 写死
 
         # 实付款
         total_pay = total_price + transit_price
@@ -59,7 +74,7 @@ class OrderPlaceView(LoginRequiresMixin, View):
         addrs = Address.objects.filter(user=user)
 
         # 组织上下文
-        sku_ids = ','.join(sku_ids)
+        sku_ids = ','.join(str(sku.id) for sku in skus)
         context = {'skus': skus,
                    'total_count': total_count,
                    'total_price': total_price,
@@ -72,9 +87,9 @@ class OrderPlaceView(LoginRequiresMixin, View):
 
 
 # mysql事务：一组sql操作，要么都成功，要么都失败
+# 悲观锁
 class OrderCommitView(View):
     '''订单创建'''
-    @transaction.atomic
     def post(self, request):
         # 判断用户是否登录
         user = request.user
@@ -101,91 +116,58 @@ class OrderCommitView(View):
         except Address.DoesNotExist:
             return JsonResponse({'res': 3, 'errmsg': '地址非法'})
 
-        # todo:创建订单核心业务
-
-        # 组织参数
-        # 订单id：201811081639 + 用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S')+str(user.id)
+        sku_ids = sku_ids.split(',')
+        conn = get_redis_connection('default')
 
-        # 总数目和总金额
-        total_count = 0
-        total_price = 0
+        if settings.ORDER_STOCK_RESERVATION:
+            # 释放超时未确认的库存预留
+            schedule_reservation_release()
 
-        # 运费
-        transit_price = 10
+        if settings.ORDER_ASYNC_COMMIT:
+            # 异步下单：放入订单队列后立即返回，前端根据ticket查询处理结果
+            ticket = uuid.uuid4().hex
+            set_order_status(conn, ticket, user.id, {'res': 8, 'message': '订单排队中'})
+            commit_order.apply_async((ticket, user.id, addr.id, pay_method, sku_ids),
+                                     queue=settings.ORDER_COMMIT_QUEUE)
+            return JsonResponse({'res': 8, 'ticket': ticket, 'message': '订单排队中'})
 
-        # 设置事务保存点
-        save_id = transaction.savepoint()
+        # todo:创建订单核心业务
         try:
-
-            # todo：向df_order_info表中添加一条记录
-            order = OrderInfo.objects.create(order_id=order_id,
-                                             user=user,
-                                             addr=addr,
-                                             pay_method=pay_method,
-                                             total_count=total_count,
-                                             total_price=total_price,
-                                             transit_price=transit_price)
-            # todo：用户的订单有几个商品，需要向df_order_goods表中加入几条记录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-
-            sku_ids = sku_ids.split(',')
-            for sku_id in sku_ids:
-                # 获取商品的信息
-                try:
-                    # select * from df_goods_sku where id=sku_id for update
-                    sku = GoodsSKU.objects.select_for_update().get(id=sku_id)
-                except:
-                    # 商品不存在
-                    transaction.savepoint_rollback(save_id)
-                    return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
-
-                # 从redis中获取用户所要购买的商品的数量
-                count = conn.hget(cart_key, sku_id)
-
-                # todo：判断商品的库存
-                if int(count) > sku.stock:
-                    transaction.savepoint_rollback(save_id)
-                    return JsonResponse({'res': 5, 'errmsg': '商品库存不足'})
-
-                # 向df_order_goods表中加入记录
-                OrderGoods.objects.create(order=order,
-                                          sku=sku,
-                                          count=count,
-                                          price=sku.price)
-
-                # todo：更新商品的库存和销量
-                sku.stock -= int(count)
-                sku.sales += int(count)
-                sku.save()
-
-                # todo：累加计算订单商品的总数量和总价格
-                amount = sku.price*int(count)
-                total_count += int(count)
-                total_price += amount
-
-            # todo： 更新订单信息表中的商品的总数量和总价格
-            order.total_count = total_count
-            order.total_price = total_price
-            order.save()
+            create_order(conn, user, addr, pay_method, sku_ids)
+        except OrderCommitError as e:
+            return JsonResponse({'res': e.res, 'errmsg': e.errmsg})
         except Exception as e:
-            transaction.savepoint_rollback(save_id)
             return JsonResponse({'res': 6, 'errmsg': '下单失败'})
 
-        # 提交事务
-        transaction.savepoint_commit(save_id)
-
-        # todo：清除用户购物车中对应的记录
-        conn.hdel(cart_key, *sku_ids)
+        if settings.ORDER_STOCK_RESERVATION:
+            # 把预留的库存写回mysql
+            schedule_stock_sync()
 
         return JsonResponse({'res': 7, 'message': '创建成功'})
 
 
-# 悲观锁
+# /order/status/ticket
+class OrderStatusView(View):
+    '''异步下单的处理结果'''
+    def get(self, request, ticket):
+        user = request.user
+        if not user.is_authenticated:
+            # 用户未登录
+            return JsonResponse({'res': 0, 'errmsg': '用户未登录'})
+
+        conn = get_redis_connection('default')
+        status = get_order_status(conn, ticket, user.id)
+        if status is None:
+            return JsonResponse({'res': 9, 'errmsg': '订单不存在'})
+
+        # res 8 排队中，7 创建成功，其他为下单失败的原因
+        return JsonResponse(status)
+
+
+# 乐观锁
 class OrderCommitView2(View):
     '''订单创建'''
-    @transaction.atomic
+    # 不在一个大事务中执行，每次乐观锁尝试使用单独的事务
     def post(self, request):
         # 判断用户是否登录
         user = request.user
@@ -213,95 +195,50 @@ class OrderCommitView2(View):
             return JsonResponse({'res': 3, 'errmsg': '地址非法'})
 
         # todo:创建订单核心业务
+        conn = get_redis_connection('default')
+        cart_store = get_cart_store()
+        sku_ids = sku_ids.split(',')
+
+        if settings.ORDER_STOCK_RESERVATION:
+            # 库存以redis中的计数器为准，不能直接修改mysql中的库存，改为预留库存下单
+            try:
+                create_order(conn, user, addr, pay_method, sku_ids)
+            except OrderCommitError as e:
+                return JsonResponse({'res': e.res, 'errmsg': e.errmsg})
+            except Exception as e:
+                return JsonResponse({'res': 6, 'errmsg': '下单失败'})
+            schedule_stock_sync()
+            return JsonResponse({'res': 7, 'message': '创建成功'})
 
         # 组织参数
-        # 订单id：201811081639 + 用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S')+str(user.id)
-
-        # 总数目和总金额
-        total_count = 0
-        total_price = 0
+        # 订单id：雪花算法生成，全局唯一且随时间递增
+        order_id = str(next_id())
 
         # 运费
         transit_price = 10
 
-        # 设置事务保存点
-        save_id = transaction.savepoint()
         try:
-
-            # todo：向df_order_info表中添加一条记录
-            order = OrderInfo.objects.create(order_id=order_id,
-                                             user=user,
-                                             addr=addr,
-                                             pay_method=pay_method,
-                                             total_count=total_count,
-                                             total_price=total_price,
-                                             transit_price=transit_price)
-            # todo：用户的订单有几个商品，需要向df_order_goods表中加入几条记录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-
-            sku_ids = sku_ids.split(',')
-            for sku_id in sku_ids:
-                for i in range(3):
-                    # 获取商品的信息
-                    try:
-                        sku = GoodsSKU.objects.get(id=sku_id)
-                    except:
-                        # 商品不存在
-                        transaction.savepoint_rollback(save_id)
-                        return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
-
-                    # 从redis中获取用户所要购买的商品的数量
-                    count = conn.hget(cart_key, sku_id)
-
-                    # todo：判断商品的库存
-                    if int(count) > sku.stock:
-                        transaction.savepoint_rollback(save_id)
-                        return JsonResponse({'res': 5, 'errmsg': '商品库存不足'})
-
-                    # todo：更新商品的库存和销量
-                    orgin_stock = sku.stock
-                    new_stock = orgin_stock -int(count)
-                    new_sales = sku.sales + int(count)
-
-                    # update df_goods_sku set stock=new_stock, sales=new_sales where id=sku_id and stock=orgin_stock
-                    # 返回受影响的行数
-                    res = GoodsSKU.objects.filter(id=sku_id, stock=orgin_stock).update(stock=new_stock, sales=new_sales)
-                    if res == 0:
-                        if i == 2:
-                            #尝试的第三次
-                            transaction.savepoint_rollback(save_id)
-                            return JsonResponse({'res': 6, 'errmsg': '下单失败2'})
-                        continue
-
-                    # 向df_order_goods表中加入记录
-                    OrderGoods.objects.create(order=order,
-                                              sku=sku,
-                                              count=count,
-                                              price=sku.price)
-
-
-                    # todo：累加计算订单商品的总数量和总价格
-                    amount = sku.price*int(count)
-                    total_count += int(count)
-                    total_price += amount
-
-                    # 跳出循环
-                    break
-
-            # todo： 更新订单信息表中的商品的总数量和总价格
-            order.total_count = total_count
-            order.total_price = total_price
-            order.save()
+            # 一次从redis中获取用户所要购买的所有商品的数量 {商品id: 数量}
+            counts = get_order_counts(cart_store, user.id, sku_ids)
+
+            # todo：向df_order_info表中添加一条记录，总数量和总价格在加入订单商品后更新
+            def create_order_info():
+                return OrderInfo.objects.create(order_id=order_id,
+                                                user=user,
+                                                addr=addr,
+                                                pay_method=pay_method,
+                                                total_count=0,
+                                                total_price=0,
+                                                transit_price=transit_price)
+
+            # todo：每次尝试在单独的事务中创建订单、更新库存，库存被其他订单修改时回滚事务，退避后重试，热点商品改用悲观锁
+            commit_order_with_retry(conn, create_order_info, counts)
+        except OrderCommitError as e:
+            return JsonResponse({'res': e.res, 'errmsg': e.errmsg})
         except Exception as e:
-            transaction.savepoint_rollback(save_id)
             return JsonResponse({'res': 6, 'errmsg': '下单失败'})
 
-        # 提交事务
-        transaction.savepoint_commit(save_id)
-
         # todo：清除用户购物车中对应的记录
-        conn.hdel(cart_key, *sku_ids)
+        cart_store.clear_many(user.id, sku_ids)
 
         return JsonResponse({'res': 7, 'message': '创建成功'})
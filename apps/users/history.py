@@ -0,0 +1,54 @@
+from apps.goods.sku_cache import get_skus_from_raw, sku_cache_key_prefix
+
+# 用户的浏览记录 [商品id, ...]，最新浏览的在最左侧
+HISTORY_KEY = 'history_%d'
+# 保存的浏览记录条数
+HISTORY_SIZE = 5
+
+# 读取浏览记录，同时读出每个商品在redis中的缓存
+# KEYS: 浏览记录
+# ARGV: 读取的条数, 商品缓存的key前缀
+# 返回 {{商品id, ...}, {缓存数据, ...}}，没有缓存的商品对应nil
+READ_HISTORY_SCRIPT = '''
+local ids = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+local values = {}
+for i, id in ipairs(ids) do
+    values[i] = redis.call('GET', ARGV[2] .. id)
+end
+return {ids, values}
+'''
+
+
+def queue_history(pipe, user_id, sku_id):
+    '''在pipeline中加入添加浏览记录的命令，和其他命令一起发送'''
+    history_key = HISTORY_KEY % user_id
+    # 移除列表中的sku_id
+    pipe.lrem(history_key, 0, sku_id)
+    # 把sku_id插入到列表的左侧
+    pipe.lpush(history_key, sku_id)
+    # 只保存用户最新浏览的HISTORY_SIZE条信息
+    pipe.ltrim(history_key, 0, HISTORY_SIZE - 1)
+
+
+def add_history(conn, user_id, sku_id):
+    '''添加用户浏览记录，一次请求完成'''
+    pipe = conn.pipeline()
+    queue_history(pipe, user_id, sku_id)
+    pipe.execute()
+
+
+def get_history_skus(conn, user_id, count=HISTORY_SIZE):
+    '''按浏览顺序获取用户最近浏览的商品，跳过已经删除的商品
+
+    一次redis请求读出浏览记录和商品缓存，缓存中没有的商品最多一次mysql查询
+    '''
+    sku_ids, raw_values = conn.register_script(READ_HISTORY_SCRIPT)(
+        keys=[HISTORY_KEY % user_id], args=[count, sku_cache_key_prefix()])
+    sku_dict = get_skus_from_raw(sku_ids, raw_values)
+
+    skus = []
+    for sku_id in sku_ids:
+        sku = sku_dict.get(int(sku_id)) if sku_id.isdigit() else None
+        if sku is not None:
+            skus.append(sku)
+    return skus
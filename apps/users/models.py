@@ -40,5 +40,9 @@ class Address(BaseModel):
 
     class Meta:
         db_table = 'df_address'
+        # 查询用户的默认收货地址
+        indexes = [
+            models.Index(fields=['user', 'is_default'], name='address_user_default_idx'),
+        ]
         verbose_name = '地址'
         verbose_name_plural = verbose_name
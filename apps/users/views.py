@@ -1,7 +1,8 @@
+import math
 import re
 
 from django.core.mail import send_mail
-from django.core.paginator import Paginator
+from django.db.models import DecimalField, ExpressionWrapper, F, Prefetch, prefetch_related_objects
 from django.http import HttpResponse
 from django_redis import get_redis_connection
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
@@ -13,11 +14,14 @@ from django.urls import reverse
 from django.views import View
 from django.conf import settings
 
+from apps.cart.anonymous import merge_anonymous_cart
 from apps.orders.models import OrderInfo, OrderGoods
+from apps.users.history import get_history_skus
 from apps.users.models import *
 from apps.goods.models import *
 from celery_tasks.tasks import send_register_active_email
 from utils.mixin import LoginRequiresMixin
+from utils.pagination import keyset_paginate
 
 
 class RegisterView(View):
@@ -111,6 +115,8 @@ class LoginView(View):
                     response.set_cookie('username', user.username, max_age=7*24*3600)
                 else:
                     response.delete_cookie('username')
+                # 把未登录时cookie中的购物车合并到用户的购物车
+                merge_anonymous_cart(request, response, user.id)
                 return response
             else:
                 return render(request, 'login.html', {'errmsg': '账户未激活，请到注册邮箱激活'})
@@ -137,19 +143,8 @@ class UserInfoView(LoginRequiresMixin, View):
         # StrictRedis(host='10.12.153.104', port='6379', db=9)
         con = get_redis_connection("default")
 
-        history_key = 'history_%d' % user.id
-
-        # 获取用户最新浏览的5个商品的id
-        sku_ids = con.lrange(history_key, 0, 4)
-
-        # 从数据库中查询用户浏览的商品的具体信息
-        # goods_li = GoodsSKU.objects.filter(id__in=sku_ids)
-
-        # 遍历获取用户浏览的商品信息
-        goods_li = []
-        for id in sku_ids:
-            goods = GoodsSKU.objects.get(id=id)
-            goods_li.append(goods)
+        # 获取用户最新浏览的5个商品的信息
+        goods_li = get_history_skus(con, user.id)
 
         # 组织上下文
         context = {'page': 'user',
@@ -161,30 +156,13 @@ class UserInfoView(LoginRequiresMixin, View):
 
 class UserOrderView(LoginRequiresMixin, View):
     '''用户中心订单'''
+    # 每页显示的订单数
+    per_page = 1
+
     def get(self, request, page):
         # 获取用户的订单信息
         user =request.user
-        orders = OrderInfo.objects.filter(user=user).order_by('-create_time')
-
-        # 遍历获取订单商品的信息
-        for order in orders:
-            # 根据order_id查询订单商品信息
-            order_skus = OrderGoods.objects.filter(order_id=order.order_id)
-
-            # 遍历order_skus计算商品的小计
-            for order_sku in order_skus:
-                # 计算小结
-                amount = order_sku.count*order_sku.price
-                # 动态给order_sku增加属性amount，保存订单商品的小计
-                order_sku.amount = amount
-
-            # 动态给order增加属性，保存订单状态标题
-            order.status_name = OrderInfo.ORDER_STATUS[order.order_status]
-            # 动态给order增加属性，保存订单商品的信息
-            order.order_skus = order_skus
-
-        # 分页
-        paginator = Paginator(orders, 1)
+        orders = OrderInfo.objects.filter(user=user)
 
         # 获取第page页的内容
         try:
@@ -192,18 +170,34 @@ class UserOrderView(LoginRequiresMixin, View):
         except Exception as e:
             page = 1
 
-        if page > paginator.num_pages:
+        # 计算总页数
+        num_pages = max(1, math.ceil(orders.count() / self.per_page))
+
+        # 相邻页面之间通过游标定位(键集分页)，深页面的查询代价和第一页相同
+        cursor = request.GET.get('cursor')
+        if page > num_pages or page < 1:
             page = 1
+            cursor = None
+
+        # 只查询第page页的订单
+        order_page = keyset_paginate(orders, ['-create_time', '-order_id'], self.per_page, page, cursor)
 
-        # 获取第page页的Page实例对象
-        order_page = paginator.page(page)
+        # 一次查询出本页所有订单的商品信息，在查询中计算商品的小计
+        order_skus = OrderGoods.objects.select_related('sku').annotate(
+            amount=ExpressionWrapper(F('count')*F('price'), output_field=DecimalField(max_digits=10, decimal_places=2)))
+        # 动态给order增加属性，保存订单商品的信息
+        prefetch_related_objects(order_page.object_list, Prefetch('ordergoods_set', queryset=order_skus,
+                                                                  to_attr='order_skus'))
+
+        for order in order_page:
+            # 动态给order增加属性，保存订单状态标题
+            order.status_name = OrderInfo.ORDER_STATUS[order.order_status]
 
         # todo：进行页码的控制，页面上最多显示5个页码
         # 1.总页数小于5页，页面上显示所有页码
         # 2.如果当前页是前3页，显示1-5页
         # 3.如果当前页是后3页，显示后5页
         # 4.其他情况，希纳是当前页的前2页，当前页，当前页的后2页
-        num_pages = paginator.num_pages
         if num_pages < 5:
             pages = range(1, num_pages + 1)
         elif page <= 3:
@@ -1,8 +1,12 @@
 # 使用celery
+import os
+
 from celery import Celery
 
 # 创建一个Celery类的实例对象
 from django.core.mail import send_mail
+from django.template import loader
+from django_redis import get_redis_connection
 
 from dailyfresh import settings
 
@@ -14,8 +18,25 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dailyfresh.settings")
 django.setup()
 '''
 
+from apps.goods.loaders import load_index_data
+from apps.goods.search_queue import SEARCH_INDEX_QUEUE_KEY, process_search_index_queue
+from apps.orders.commit import OrderCommitError
+from apps.orders.reservation import RESERVATION_EXPIRE_KEY, release_expired_reservations, sync_stock_to_db
+from apps.orders.service import create_order, set_order_status
+from apps.users.models import Address, User
+
 app = Celery('celery_tasks.tasks', broker='redis://10.12.153.104:6379/8')
 
+# 任务待执行标记，用于合并短时间内的多次调度
+# 首页静态页面
+STATIC_INDEX_PENDING_KEY = 'static_index_pending'
+# 库存预留写回mysql
+STOCK_SYNC_PENDING_KEY = 'stock_sync_pending'
+# 释放过期的库存预留
+RESERVATION_RELEASE_PENDING_KEY = 'reservation_release_pending'
+# 批量更新搜索索引
+SEARCH_INDEX_PENDING_KEY = 'search_index_pending'
+
 
 # 定义任务函数
 @app.task
@@ -32,6 +53,102 @@ def send_register_active_email(to_email, username, token):
     send_mail(subject, message, sender, receiver, html_message=html_message)
 
 
+@app.task
 def generate_static_index_html():
     '''产生首页静态页面'''
+    # 先清除待生成标记，生成期间再有修改会重新排队一次
+    conn = get_redis_connection('default')
+    conn.delete(STATIC_INDEX_PENDING_KEY)
+
+    # 获取首页展示的数据，静态页面只给未登录用户使用，购物车数目为0
+    context = load_index_data()
+    context['cart_count'] = 0
+
+    # 使用模板
+    temp = loader.get_template('index.html')
+    static_index_html = temp.render(context)
+
+    # 先写临时文件再替换，避免读到写了一半的页面
+    save_path = settings.STATIC_INDEX_PATH
+    tmp_path = save_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        f.write(static_index_html)
+    os.replace(tmp_path, save_path)
+
+
+def _schedule(task, pending_key, countdown):
+    '''延迟countdown秒执行任务，任务执行前的多次调度只执行一次'''
+    conn = get_redis_connection('default')
+    # 已经有排队中的任务时直接返回
+    # 标记设置过期时间，防止celery任务丢失后再也无法触发
+    if conn.set(pending_key, 1, nx=True, ex=countdown + 60):
+        task.apply_async(countdown=countdown)
+
+
+def schedule_static_index_html():
+    '''后台修改首页数据后调用，合并一段时间内的多次修改只生成一次首页静态页面'''
+    _schedule(generate_static_index_html, STATIC_INDEX_PENDING_KEY, settings.STATIC_INDEX_DEBOUNCE)
+
+
+@app.task
+def sync_reserved_stock():
+    '''把redis中已确认的库存预留批量写回mysql'''
+    conn = get_redis_connection('default')
+    conn.delete(STOCK_SYNC_PENDING_KEY)
+    sync_stock_to_db(conn)
+
+
+def schedule_stock_sync():
+    '''订单确认库存预留后调用，一段时间内的所有订单一起写回mysql'''
+    _schedule(sync_reserved_stock, STOCK_SYNC_PENDING_KEY, settings.STOCK_SYNC_INTERVAL)
+
+
+@app.task
+def release_reservations():
+    '''释放过期的库存预留，还有未过期的预留时继续调度'''
+    conn = get_redis_connection('default')
+    conn.delete(RESERVATION_RELEASE_PENDING_KEY)
+    release_expired_reservations(conn)
+    if conn.zcard(RESERVATION_EXPIRE_KEY):
+        schedule_reservation_release()
+
+
+def schedule_reservation_release():
+    '''预留库存后调用，在预留过期后释放未确认的预留'''
+    _schedule(release_reservations, RESERVATION_RELEASE_PENDING_KEY, settings.STOCK_RESERVATION_TTL)
+
+
+@app.task
+def update_search_index():
+    '''批量更新队列中商品的搜索索引，处理期间又有商品修改时继续调度'''
+    conn = get_redis_connection('default')
+    conn.delete(SEARCH_INDEX_PENDING_KEY)
+    process_search_index_queue(conn)
+    if conn.scard(SEARCH_INDEX_QUEUE_KEY):
+        schedule_search_index_update()
+
+
+def schedule_search_index_update():
+    '''商品修改后调用，合并一段时间内的所有修改批量更新索引'''
+    _schedule(update_search_index, SEARCH_INDEX_PENDING_KEY, settings.SEARCH_INDEX_DEBOUNCE)
+
+
+@app.task
+def commit_order(ticket, user_id, addr_id, pay_method, sku_ids):
+    '''异步创建订单，处理结果保存到redis中'''
+    conn = get_redis_connection('default')
+    try:
+        user = User.objects.get(id=user_id)
+        addr = Address.objects.get(id=addr_id)
+        order = create_order(conn, user, addr, pay_method, sku_ids)
+    except OrderCommitError as e:
+        status = {'res': e.res, 'errmsg': e.errmsg}
+    except Exception as e:
+        status = {'res': 6, 'errmsg': '下单失败'}
+    else:
+        status = {'res': 7, 'message': '创建成功', 'order_id': order.order_id}
+        if settings.ORDER_STOCK_RESERVATION:
+            # 把预留的库存写回mysql
+            schedule_stock_sync()
 
+    set_order_status(conn, ticket, user_id, status)
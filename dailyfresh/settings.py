@@ -91,6 +91,15 @@ DATABASES = {
     }
 }
 
+# 本地测试使用sqlite: DJANGO_TEST_SQLITE=1 python manage.py test
+if os.environ.get('DJANGO_TEST_SQLITE'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        }
+    }
+
 # django认证系统使用的模型类
 AUTH_USER_MODEL = 'users.User'
 
@@ -133,6 +142,12 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
 
+# 首页静态页面的保存路径，未登录用户直接访问该页面
+STATIC_INDEX_PATH = os.path.join(BASE_DIR, 'static', 'index.html')
+
+# 后台修改首页数据后，延迟多少秒生成首页静态页面(该时间内的多次修改只生成一次)
+STATIC_INDEX_DEBOUNCE = 10
+
 # 富文本编辑器
 TINYMCE_DEFAULT_CONFIG = {
     'theme': 'advanced',
@@ -165,6 +180,59 @@ CACHES = {
 }
 
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
+
+# 下单时先在redis中预留库存，库存和销量由后台任务批量写回mysql
+# 关闭时直接在mysql中锁定商品扣减库存。切换前需要先写回所有预留并删除redis中的库存计数器
+ORDER_STOCK_RESERVATION = True
+# 库存预留的有效时间(秒)，超时未确认的预留会被释放
+STOCK_RESERVATION_TTL = 300
+# 已确认的库存预留写回mysql的间隔(秒)和每批的商品数
+STOCK_SYNC_INTERVAL = 5
+STOCK_SYNC_BATCH_SIZE = 500
+
+# 乐观锁下单：库存冲突时的最大重试次数，退避时间的基数和上限(秒)
+ORDER_OPTIMISTIC_RETRIES = 5
+ORDER_OPTIMISTIC_BACKOFF = 0.01
+ORDER_OPTIMISTIC_BACKOFF_MAX = 0.2
+# 为True时忽略重试次数，一直重试到库存确实不足，最长等待ORDER_OPTIMISTIC_MAX_WAIT秒
+ORDER_OPTIMISTIC_RETRY_UNTIL_SHORTAGE = False
+ORDER_OPTIMISTIC_MAX_WAIT = 2
+# 商品在HOT_SKU_WINDOW秒内冲突HOT_SKU_CONFLICT_THRESHOLD次后，HOT_SKU_TTL秒内改用悲观锁下单
+HOT_SKU_WINDOW = 60
+HOT_SKU_CONFLICT_THRESHOLD = 20
+HOT_SKU_TTL = 600
+
+# 异步下单：请求只校验参数并放入celery队列，由worker创建订单，前端轮询/order/status/<ticket>获取结果
+# 需要启动处理订单队列的worker: celery -A celery_tasks.tasks worker -Q order
+ORDER_ASYNC_COMMIT = False
+ORDER_COMMIT_QUEUE = 'order'
+# 异步下单处理结果的保存时间(秒)
+ORDER_STATUS_TTL = 3600
+
+# 订单id生成器的机器id租约有效时间(秒)，每个进程从redis获取一个机器id，每过1/3的时间续期一次
+SNOWFLAKE_LEASE_TTL = 60
+
+# 首页数据缓存的过期时间(秒)，数据修改时通过版本号失效，过期时间只是兜底
+INDEX_DATA_CACHE_TIMEOUT = 3600
+
+# 商品信息缓存：redis中的缓存时间(秒)，进程内LRU缓存的大小和缓存时间(秒)
+# 商品修改时清除redis缓存，其他进程的进程内缓存最多SKU_LOCAL_CACHE_TIMEOUT秒后更新
+SKU_CACHE_TIMEOUT = 60
+SKU_LOCAL_CACHE_SIZE = 1000
+SKU_LOCAL_CACHE_TIMEOUT = 5
+
+# 列表页种类商品数量的缓存时间(秒)
+TYPE_SKU_COUNT_CACHE_TIMEOUT = 600
+
+# 购物车存储：redis 或 memory(进程内存，只用于测试和性能测试)
+CART_STORE_BACKEND = os.environ.get('CART_STORE_BACKEND', 'redis')
+
+# 未登录用户的购物车保存在签名cookie中：保存时间(秒)和最多的商品条目数(cookie大小有限制)
+ANONYMOUS_CART_COOKIE_AGE = 14 * 24 * 3600
+ANONYMOUS_CART_MAX_LINES = 50
+
+# 批量修改购物车时一次最多的修改条数
+CART_BATCH_MAX_OPS = 100
 SESSION_CACHE_ALIAS = "default"
 
 # 在访问需要登录的页面时，跳转到以下页面
@@ -184,14 +252,27 @@ HAYSTACK_CONNECTIONS = {
     'default': {
         #使用whoosh引擎
         # 'ENGINE': 'haystack.backends.whoosh_backend.WhooshEngine',
-        'ENGINE': 'haystack.backends.whoosh_cn_backend.WhooshEngine',
+        # 'ENGINE': 'haystack.backends.whoosh_cn_backend.WhooshEngine',
+        # 中文分词，种类、价格、销量字段可以直接排序和分面统计
+        'ENGINE': 'apps.goods.whoosh_backend.SortableWhooshEngine',
         #索引文件路径
         'PATH': os.path.join(BASE_DIR, 'whoosh_index'),
     }
 }
 
-#当添加、修改、删除数据时，自动生成索引
-HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+#当添加、修改、删除数据时，把商品放入队列，由celery任务批量更新索引
+HAYSTACK_SIGNAL_PROCESSOR = 'apps.goods.search_queue.QueuedSignalProcessor'
+
+# 商品修改后合并SEARCH_INDEX_DEBOUNCE秒内的修改批量更新索引，每批最多SEARCH_INDEX_BATCH_SIZE个商品
+SEARCH_INDEX_DEBOUNCE = 5
+SEARCH_INDEX_BATCH_SIZE = 200
+
+# 搜索结果的缓存时间(秒)
+SEARCH_CACHE_TIMEOUT = 60
+
+# 搜索联想：保存的最长前缀(字数)和返回的条数
+SUGGEST_MAX_PREFIX_LENGTH = 10
+SUGGEST_LIMIT = 10
 
 # 控制每页显示数量
 HAYSTACK_SEARCH_RESULTS_PER_PAGE = 5
@@ -19,7 +19,6 @@ from django.urls import path, include
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('tinymce/', include('tinymce.urls')),  # 富文本编辑器
-    path('search/', include('haystack.urls')),  # 全文检索框架
     path('user/', include('apps.users.urls', namespace='user')),  # 用户模块
     path('cart/', include('apps.cart.urls', namespace='cart')),  # 购物车模块
     path('order/', include('apps.orders.urls', namespace='order')),  # 订单模块
@@ -0,0 +1,128 @@
+import base64
+import json
+from datetime import datetime
+from decimal import Decimal
+
+from django.db.models import Q
+
+# 键集分页(seek)：根据上一页最后一条(或下一页第一条)记录的排序字段值定位，
+# 不需要OFFSET扫描前面的记录，任意深的页面代价都和第一页相同
+
+
+def encode_cursor(values, direction):
+    '''把排序字段的值编码为不透明的游标字符串，direction: next 下一页 prev 上一页'''
+    data = []
+    for value in values:
+        if isinstance(value, (datetime, Decimal)):
+            value = str(value)
+        data.append(value)
+    token = json.dumps({'k': data, 'd': direction}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(token.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, size):
+    '''解析游标，返回(排序字段的值, 方向)，游标非法时返回None'''
+    if not token:
+        return None
+    try:
+        token += '=' * (-len(token) % 4)
+        data = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+        values, direction = data['k'], data['d']
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+    if direction not in ('next', 'prev') or not isinstance(values, list) or len(values) != size:
+        return None
+    return values, direction
+
+
+def _seek_filter(ordering, values, direction):
+    # (f1 > v1) or (f1 = v1 and f2 > v2) or ...，降序字段使用 <，向前翻页时方向相反
+    condition = Q()
+    for i, field in enumerate(ordering):
+        name = field.lstrip('-')
+        descending = field.startswith('-')
+        if direction == 'prev':
+            descending = not descending
+        q = Q(**{'%s__%s' % (name, 'lt' if descending else 'gt'): values[i]})
+        for prev_field, prev_value in zip(ordering[:i], values[:i]):
+            q &= Q(**{prev_field.lstrip('-'): prev_value})
+        condition |= q
+    return condition
+
+
+def _reverse(ordering):
+    return [field[1:] if field.startswith('-') else '-' + field for field in ordering]
+
+
+class KeysetPage(object):
+    '''键集分页的一页数据，和django的Page有相同的模板接口'''
+    def __init__(self, object_list, number, has_previous, has_next, ordering):
+        self.object_list = object_list
+        self.number = number
+        self._has_previous = has_previous
+        self._has_next = has_next
+        self.ordering = ordering
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_next(self):
+        return self._has_next
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def _cursor(self, obj, direction):
+        return encode_cursor([getattr(obj, field.lstrip('-')) for field in self.ordering], direction)
+
+    @property
+    def next_cursor(self):
+        '''下一页的游标'''
+        if not self._has_next:
+            return ''
+        return self._cursor(self.object_list[-1], 'next')
+
+    @property
+    def previous_cursor(self):
+        '''上一页的游标'''
+        if not self._has_previous:
+            return ''
+        return self._cursor(self.object_list[0], 'prev')
+
+
+def keyset_paginate(queryset, ordering, per_page, number, cursor=None):
+    '''获取第number页的数据
+
+    ordering: 排序字段，最后一个字段必须唯一(一般是主键)，例如 ['-create_time', '-order_id']
+    cursor: 相邻页面提供的游标，有游标时使用键集定位，没有游标或游标非法时使用OFFSET定位
+    每次只查询per_page+1条记录，多出的一条用于判断是否还有下一页(上一页)
+    '''
+    cursor = decode_cursor(cursor, len(ordering))
+    if cursor is None:
+        start = (number - 1) * per_page
+        object_list = list(queryset.order_by(*ordering)[start:start + per_page + 1])
+        has_next = len(object_list) > per_page
+        return KeysetPage(object_list[:per_page], number, number > 1, has_next, ordering)
+
+    values, direction = cursor
+    if direction == 'next':
+        object_list = list(queryset.filter(_seek_filter(ordering, values, 'next'))
+                           .order_by(*ordering)[:per_page + 1])
+        has_next = len(object_list) > per_page
+        return KeysetPage(object_list[:per_page], number, number > 1, has_next, ordering)
+
+    # 向前翻页：反向排序取per_page+1条再倒过来
+    object_list = list(queryset.filter(_seek_filter(ordering, values, 'prev'))
+                       .order_by(*_reverse(ordering))[:per_page + 1])
+    has_previous = len(object_list) > per_page
+    object_list = object_list[:per_page][::-1]
+    return KeysetPage(object_list, number, has_previous, True, ordering)
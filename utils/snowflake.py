@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+# 起始时间 2018-01-01 00:00:00 UTC(毫秒)，41位时间戳可以使用约69年
+EPOCH = 1514764800000
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# 机器id的租约，每个进程持有一个并定时续期，进程退出后租约过期，机器id可以被其他进程使用
+WORKER_LEASE_KEY = 'snowflake_worker:%d'
+# 获取机器id时查找的起始位置，各进程从不同的位置开始查找
+WORKER_ID_KEY = 'snowflake_worker_id'
+
+# 租约仍属于当前进程时续期
+# KEYS: 租约
+# ARGV: 进程的token, 有效时间(秒)
+RENEW_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+
+def acquire_worker_id(conn, token, ttl):
+    '''获取一个没有被其他进程使用的机器id，租约有效ttl秒，所有机器id都被占用时抛出RuntimeError'''
+    start = conn.incr(WORKER_ID_KEY)
+    for i in range(MAX_WORKER_ID + 1):
+        worker_id = (start + i) & MAX_WORKER_ID
+        if conn.set(WORKER_LEASE_KEY % worker_id, token, nx=True, ex=ttl):
+            return worker_id
+    raise RuntimeError('没有可用的机器id')
+
+
+def renew_worker_id(conn, worker_id, token, ttl):
+    '''续期机器id的租约，租约已经过期时返回False，需要重新获取机器id'''
+    return bool(conn.register_script(RENEW_SCRIPT)(keys=[WORKER_LEASE_KEY % worker_id], args=[token, ttl]))
+
+
+class Snowflake(object):
+    '''雪花算法id生成器：41位毫秒时间戳 + 10位机器id + 12位序列号
+
+    同一个生成器每毫秒最多生成4096个id，id随时间递增，线程安全
+    '''
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError('worker_id必须在0到%d之间' % MAX_WORKER_ID)
+        self.worker_id = worker_id
+        self.last_timestamp = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def _now(self):
+        return int(time.time() * 1000)
+
+    def next_id(self):
+        '''生成一个新的id'''
+        with self.lock:
+            timestamp = self._now()
+            if timestamp < self.last_timestamp:
+                # 系统时钟回拨，小幅回拨时沿用上次的时间继续生成
+                if self.last_timestamp - timestamp > 1000:
+                    raise RuntimeError('系统时钟回拨%d毫秒' % (self.last_timestamp - timestamp))
+                timestamp = self.last_timestamp
+
+            if timestamp == self.last_timestamp:
+                # 同一毫秒内序列号加1，用完时等到下一毫秒
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    while timestamp <= self.last_timestamp:
+                        timestamp = self._now()
+            else:
+                self.sequence = 0
+            self.last_timestamp = timestamp
+
+            return ((timestamp - EPOCH) << (WORKER_ID_BITS + SEQUENCE_BITS)) | \
+                   (self.worker_id << SEQUENCE_BITS) | self.sequence
+
+
+_generator = None
+_generator_pid = None
+_lease_token = None
+_lease_renew_at = 0
+_generator_lock = threading.Lock()
+
+
+def _get_generator():
+    # 每个进程使用自己的生成器和机器id租约，fork出的子进程重新获取机器id
+    # 每过租约有效时间的1/3续期一次，租约已经过期(可能已被其他进程获取)时换一个机器id
+    global _generator, _generator_pid, _lease_token, _lease_renew_at
+    pid = os.getpid()
+    if _generator_pid != pid or time.monotonic() >= _lease_renew_at:
+        with _generator_lock:
+            now = time.monotonic()
+            if _generator_pid != pid or now >= _lease_renew_at:
+                conn = get_redis_connection('default')
+                ttl = settings.SNOWFLAKE_LEASE_TTL
+                if _generator_pid != pid or not renew_worker_id(conn, _generator.worker_id, _lease_token, ttl):
+                    _lease_token = uuid.uuid4().hex
+                    _generator = Snowflake(acquire_worker_id(conn, _lease_token, ttl))
+                    _generator_pid = pid
+                _lease_renew_at = now + ttl / 3
+    return _generator
+
+
+def next_id():
+    '''生成一个全局唯一的id'''
+    return _get_generator().next_id()